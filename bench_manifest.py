@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+'''
+Benchmark build_manifest.py against a synthetic AbacusSummit-shaped tree.
+
+Generates a tree of base and small sims under tmpfs, in which every product
+file is a hard link to a tiny, valid ASDF file holding just the sim header.
+Then times and memory-profiles the scan (find_products), the small-sim
+collapse (_collapsed_manifest), the rollup cube (make_rollup), and the JSON
+output separately.  Results are written as JSON so that later runs can be
+compared with --compare.
+
+Usage
+-----
+$ ./bench_manifest.py --nbase 10 --nsmall 200 -o bench.json
+$ ./bench_manifest.py --nbase 10 --nsmall 200 --compare bench.json
+'''
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import asdf
+
+import build_manifest
+from build_manifest import DEFAULT_PRODUCTS, DEFAULT_REDSHIFTS, DEFAULT_SIM_PATS
+
+DEFAULT_TMPDIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+BASE_HEADER = dict(BoxSize=2000., NP=6912**3, ParticleMassHMsun=2.109e9,
+                   SimComment='Synthetic base simulation')
+SMALL_HEADER = dict(BoxSize=500., NP=1728**3, ParticleMassHMsun=2.109e9,
+                    SimComment='Synthetic small simulation')
+
+
+def make_tree(root, nbase=4, nsmall=100, nz=len(DEFAULT_REDSHIFTS), nfile=8,
+              nlcfile=256, products=DEFAULT_PRODUCTS):
+    '''Build a synthetic sim tree under `root`. Every product file is a hard
+    link to one tiny ASDF file with the sim's header. Only the base sims get
+    light cones, with `nlcfile` files per ftype.
+    '''
+    root = Path(root)
+    redshifts = DEFAULT_REDSHIFTS[:nz]
+
+    templates = {}
+    for kind, header in (('base', BASE_HEADER), ('small', SMALL_HEADER)):
+        templates[kind] = root / f'header_{kind}.asdf'
+        asdf.AsdfFile(dict(header=header)).write_to(templates[kind])
+
+    sims = [f'AbacusSummit_base_c000_ph{i:03d}' for i in range(nbase)]
+    sims += [f'small/AbacusSummit_small_c000_ph{3000 + i}' for i in range(nsmall)]
+
+    for sim in sims:
+        template = templates['small' if sim.startswith('small/') else 'base']
+        for prod in products.values():
+            if not prod.get('redshifts', True):
+                if sim.startswith('small/'):
+                    continue
+                fdirs = [(root / prod['path'].format(sim) / ftype, ftype, nlcfile)
+                         for ftype in prod['ftypes']]
+            else:
+                fdirs = [(root / prod['path'].format(sim) / f'z{z:.3f}' / ftype, ftype, nfile)
+                         for z in redshifts for ftype in prod['ftypes']]
+            for fdir, ftype, n in fdirs:
+                fdir.mkdir(parents=True)
+                for i in range(n):
+                    os.link(template, fdir / f'{ftype}_{i:03d}.asdf')
+
+    return len(sims)
+
+
+def measure(fn, *args, repeat=1, **kwargs):
+    '''Call `fn`, returning its result, the best wall time over `repeat`
+    calls, and the peak traced memory of one extra call.
+    '''
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        res = fn(*args, **kwargs)
+        times += [time.perf_counter() - t]
+
+    tracemalloc.start()
+    fn(*args, **kwargs)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return res, dict(time_s=min(times), peak_mem_bytes=peak)
+
+
+def run(root, repeat=1):
+    '''Benchmark each manifest builder phase on the tree at `root`.'''
+    root = Path(root)
+    out = root / 'out'
+    out.mkdir()
+
+    def scan():
+        files = []
+        rows = build_manifest.scan_sims(root, DEFAULT_SIM_PATS, file_index=files)
+        return rows, files
+
+    (rows, files), res_scan = measure(scan, repeat=repeat)
+    manifest = build_manifest.make_manifest(rows)
+
+    collapsed, res_collapse = measure(build_manifest._collapsed_manifest, manifest,
+                                      repeat=repeat)
+
+    rollup, res_rollup = measure(build_manifest.make_rollup, manifest, repeat=repeat)
+
+    _, res_json = measure(build_manifest.write_manifests, manifest, collapsed, out,
+                          rollup=rollup, repeat=repeat)
+
+    results = {'find_products': res_scan,
+               '_collapsed_manifest': res_collapse,
+               'make_rollup': res_rollup,
+               'json_output': res_json,
+               }
+    counts = dict(nrow=len(rows), nrow_collapsed=len(collapsed['data']),
+                  ndir=len(files), nfile=sum(len(listing) for _, listing in files),
+                  json_bytes=(out / 'simulations.json').stat().st_size,
+                  table_json_bytes=(out / 'simulations.table.json').stat().st_size,
+                  rollup_cells=len(rollup['nfile']),
+                  rollup_json_bytes=(out / 'simulations.rollup.json').stat().st_size,
+                  )
+
+    return results, counts
+
+
+def git_rev():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              capture_output=True, text=True, check=True,
+                              cwd=Path(__file__).parent).stdout.strip()
+    except Exception:
+        return None
+
+
+def compare(new, old):
+    '''Print a table of the new/old ratios of each phase.'''
+    if old['params'] != new['params']:
+        print('Warning: benchmark parameters differ from the comparison run')
+    print(f'{"phase":<22} {"time (s)":>20} {"ratio":>7} {"peak mem (MB)":>22} {"ratio":>7}')
+    for phase, r in new['results'].items():
+        o = old['results'].get(phase)
+        if not o:
+            continue
+        print(f'{phase:<22} {o["time_s"]:9.4g} -> {r["time_s"]:<8.4g} {r["time_s"]/o["time_s"]:7.3f} '
+              f'{o["peak_mem_bytes"]/1e6:10.4g} -> {r["peak_mem_bytes"]/1e6:<9.4g} '
+              f'{r["peak_mem_bytes"]/max(o["peak_mem_bytes"],1):7.3f}')
+
+
+def main(nbase=4, nsmall=100, nz=len(DEFAULT_REDSHIFTS), nfile=8, nlcfile=256, repeat=3,
+         tmpdir=DEFAULT_TMPDIR, out=None, compare_to=None, keep=False):
+    params = dict(nbase=nbase, nsmall=nsmall, nz=nz, nfile=nfile, nlcfile=nlcfile, repeat=repeat)
+
+    root = Path(tempfile.mkdtemp(prefix='bench_manifest_', dir=tmpdir))
+    try:
+        t = time.perf_counter()
+        make_tree(root, nbase=nbase, nsmall=nsmall, nz=nz, nfile=nfile, nlcfile=nlcfile)
+        print(f'Generated synthetic tree in {root} in {time.perf_counter() - t:.3g} s')
+
+        results, counts = run(root, repeat=repeat)
+    finally:
+        if not keep:
+            shutil.rmtree(root)
+
+    bench = dict(params=params, counts=counts, results=results,
+                 git_rev=git_rev(), python=platform.python_version(),
+                 timestamp=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                 )
+
+    print(json.dumps(bench, indent=4))
+    if out:
+        with open(out, 'w') as fp:
+            json.dump(bench, fp, indent=4)
+    if compare_to:
+        with open(compare_to) as fp:
+            compare(bench, json.load(fp))
+
+
+class ArgParseFormatter(argparse.RawDescriptionHelpFormatter,
+                        argparse.ArgumentDefaultsHelpFormatter):
+    pass
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=ArgParseFormatter)
+    parser.add_argument('--nbase', help='Number of base sims', type=int, default=4)
+    parser.add_argument('--nsmall', help='Number of small sims', type=int, default=100)
+    parser.add_argument('--nz', help='Number of redshifts per sim', type=int, default=len(DEFAULT_REDSHIFTS))
+    parser.add_argument('--nfile', help='Number of files per ftype directory', type=int, default=8)
+    parser.add_argument('--nlcfile', help='Number of files per light cone ftype directory', type=int, default=256)
+    parser.add_argument('--repeat', help='Number of timed runs per phase (best is reported)', type=int, default=3)
+    parser.add_argument('--tmpdir', help='Where to generate the tree (ideally tmpfs)', default=DEFAULT_TMPDIR)
+    parser.add_argument('-o', '--out', help='Output JSON file for the results')
+    parser.add_argument('--compare', help='Previous results JSON to compare against', dest='compare_to')
+    parser.add_argument('--keep', help="Don't delete the synthetic tree", action='store_true')
+
+    args = parser.parse_args()
+    args = vars(args)
+
+    main(**args)
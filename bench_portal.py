@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+'''
+Load-test the data portal Flask app in-process against a fake Globus.
+
+Drives `/transfer` (POST), `/submit-transfer` (POST) and `/browse` with
+concurrent clients, each with a pre-authenticated session.  The Globus
+`TransferClient` and `ConfidentialAppAuthClient` are replaced by in-process
+fakes with configurable latency and error rate, so the numbers measure the
+portal's own submission path (plus our Globus admission control), not
+Globus.  Reports throughput and p50/p99 latency per route, as JSON, and can
+compare against a previous run.
+
+Runs against the manifest the portal is configured with (the production
+manifest, when run from a deployment), or the one given with --manifest.
+
+Usage
+-----
+$ ./bench_portal.py --clients 16 --duration 30 -o bench_portal.json
+$ ./bench_portal.py --clients 16 --duration 30 --compare bench_portal.json
+'''
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from pathlib import Path
+
+import requests
+from globus_sdk import TransferAPIError
+
+WEB_DIR = Path(__file__).parent / 'web'
+
+ROUTES = ('transfer', 'submit-transfer', 'browse')
+
+
+class FakeGlobus:
+    '''Shared latency and error settings for the fake clients.'''
+
+    def __init__(self, latency=0.05, jitter=0.5, error_rate=0.):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+
+    def call(self):
+        '''Sleep for the simulated latency, and maybe raise a 503.'''
+        time.sleep(self.latency * random.uniform(1 - self.jitter, 1 + self.jitter))
+        if random.random() < self.error_rate:
+            r = requests.Response()
+            r.status_code = 503
+            r.headers['Content-Type'] = 'application/json'
+            r._content = b'{"code": "ServiceUnavailable", "message": "Fake outage"}'
+            raise TransferAPIError(r)
+
+
+class FakeAuthClient:
+    '''Stands in for ConfidentialAppAuthClient; tokens are never refreshed.'''
+
+    def __init__(self, fake):
+        self.fake = fake
+
+
+class FakeTransferClient:
+    '''Implements the subset of TransferClient that the portal uses.'''
+
+    def __init__(self, fake):
+        self.fake = fake
+
+    def endpoint_autoactivate(self, endpoint_id, **params):
+        self.fake.call()
+        return {'code': 'AlreadyActivated'}
+
+    def get_endpoint(self, endpoint_id, **params):
+        self.fake.call()
+        return {'id': endpoint_id, 'display_name': 'Fake endpoint',
+                'gcs_version': '5.3.0', 'high_assurance': False,
+                'non_functional': False,
+                'https_server': 'https://fake.data.globus.org'}
+
+    def operation_ls(self, endpoint_id, **params):
+        self.fake.call()
+        return [{'type': 'file', 'name': f'halo_info_{i:03d}.asdf', 'size': 10**9}
+                for i in range(34)]
+
+    def get_submission_id(self, **params):
+        self.fake.call()
+        return {'value': str(uuid.uuid4())}
+
+    def submit_transfer(self, data):
+        self.fake.call()
+        return {'task_id': str(uuid.uuid4()), 'code': 'Accepted'}
+
+
+def load_portal(fake, manifest=None):
+    '''Import the portal app with the fake Globus clients patched in.'''
+    for var in ('PORTAL_SERVER_NAME', 'GLOBUS_GLOBAL_SECRET',
+                'GLOBUS_CLIENT_ID', 'GLOBUS_CLIENT_SECRET'):
+        os.environ.setdefault(var, 'localhost' if var == 'PORTAL_SERVER_NAME' else 'fake')
+
+    # the portal config uses paths relative to web/
+    os.chdir(WEB_DIR)
+    sys.path.insert(0, str(WEB_DIR))
+
+    import portal
+    import portal.views
+
+    if getattr(portal, 'transfer_poller', None):
+        portal.transfer_poller.stop()
+
+    portal.views.load_transfer_client = lambda: FakeTransferClient(fake)
+    portal.views.load_portal_client = lambda: FakeAuthClient(fake)
+
+    # don't write test transfers into the real database
+    tmpdir = tempfile.mkdtemp(prefix='bench_portal_')
+    shutil.copy(portal.app.config['DATABASE'], tmpdir + '/app.db')
+    portal.app.config['DATABASE'] = tmpdir + '/app.db'
+
+    if manifest:
+        with open(manifest) as fp:
+            portal.datasets.clear()
+            portal.datasets.update(json.load(fp))
+        # don't let a published build replace this manifest mid-benchmark
+        portal.manifest_watcher.interval = 0
+
+    return portal, tmpdir
+
+
+def login(client, selection):
+    '''Give the test client an authenticated session with a saved selection.'''
+    with client.session_transaction() as sess:
+        sess.update(
+            is_authenticated=True,
+            name='Load Test', email='loadtest@example.org', institution='Bench',
+            primary_username='loadtest', primary_identity=str(uuid.uuid4()),
+            tokens={'transfer.api.globus.org': dict(refresh_token='fake',
+                                                    access_token='fake',
+                                                    expires_at_seconds=2**31)},
+            form=selection,
+        )
+
+
+def make_selection(datasets, nsim):
+    '''Select the first `nsim` sims, all redshifts, and all products.'''
+    products = ','.join(f'{p}.{ftype}' for p, desc in datasets['products'].items()
+                        for ftype in desc['ftypes'])
+    return {'redshifts[]': [str(z) for z in datasets['redshifts']],
+            'products[]': [products],
+            'simids[]': [f'0-{min(nsim, len(datasets["data"])) - 1}'],
+            }
+
+
+def request(client, route, selection, endpoint_id):
+    if route == 'transfer':
+        return client.post('/transfer', data=selection)
+    if route == 'submit-transfer':
+        return client.post('/submit-transfer',
+                           data={'endpoint_id': str(uuid.uuid4()), 'path': '/~/',
+                                 'folder[0]': 'abacus', 'label': 'load test'})
+    if route == 'browse':
+        return client.get(f'/browse/endpoint/{endpoint_id}/AbacusSummit_base_c000_ph000/halos')
+    raise ValueError(route)
+
+
+def worker(app, route, selection, deadline, latencies, errors):
+    client = app.test_client()
+    login(client, selection)
+    endpoint_id = app.config['DATASET_ENDPOINT_ID']
+    while time.perf_counter() < deadline:
+        t = time.perf_counter()
+        try:
+            r = request(client, route, selection, endpoint_id)
+            ok = r.status_code < 400
+        except Exception:
+            ok = False
+        latencies += [time.perf_counter() - t]
+        if not ok:
+            errors += [route]
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q/100 * len(values)))] if values else None
+
+
+def run(app, selection, clients=8, duration=10., routes=ROUTES):
+    '''Hammer each route in turn with `clients` concurrent clients.'''
+    results = {}
+    for route in routes:
+        latencies = []
+        errors = []
+        deadline = time.perf_counter() + duration
+        threads = [threading.Thread(target=worker,
+                                    args=(app, route, selection, deadline, latencies, errors))
+                   for _ in range(clients)]
+        t = time.perf_counter()
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        elapsed = time.perf_counter() - t
+
+        results[route] = dict(nrequest=len(latencies), nerror=len(errors),
+                              throughput_per_s=len(latencies)/elapsed,
+                              p50_s=percentile(latencies, 50),
+                              p99_s=percentile(latencies, 99),
+                              )
+        print(f'{route:<16} {results[route]["throughput_per_s"]:8.1f} req/s  '
+              f'p50 {results[route]["p50_s"]*1e3:7.1f} ms  p99 {results[route]["p99_s"]*1e3:7.1f} ms  '
+              f'{len(errors)} errors')
+
+    return results
+
+
+def compare(new, old):
+    '''Print the new/old ratios of throughput and latency for each route.'''
+    if old['params'] != new['params']:
+        print('Warning: benchmark parameters differ from the comparison run')
+    print(f'{"route":<16} {"throughput":>10} {"p50":>7} {"p99":>7}  (new/old)')
+    for route, r in new['results'].items():
+        o = old['results'].get(route)
+        if not o or not o['nrequest'] or not r['nrequest']:
+            continue
+        print(f'{route:<16} {r["throughput_per_s"]/o["throughput_per_s"]:10.3f} '
+              f'{r["p50_s"]/o["p50_s"]:7.3f} {r["p99_s"]/o["p99_s"]:7.3f}')
+
+
+def main(clients=8, duration=10., nsim=100, latency=0.05, error_rate=0.,
+         manifest=None, routes=ROUTES, out=None, compare_to=None):
+    params = dict(clients=clients, duration=duration, nsim=nsim, latency=latency,
+                  error_rate=error_rate, manifest=manifest, routes=list(routes))
+    if out:
+        out = Path(out).absolute()
+    if compare_to:
+        compare_to = Path(compare_to).absolute()
+
+    fake = FakeGlobus(latency=latency, error_rate=error_rate)
+    portal, tmpdir = load_portal(fake, manifest=manifest)
+    try:
+        selection = make_selection(portal.datasets, nsim)
+        results = run(portal.app, selection, clients=clients, duration=duration,
+                      routes=routes)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    bench = dict(params=params, results=results,
+                 globus_limiter=portal.globus_limiter.stats(),
+                 transfer_plans=portal.transfer_plans.stats(),
+                 python=platform.python_version(),
+                 timestamp=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                 )
+
+    print(json.dumps(bench, indent=4))
+    if out:
+        with open(out, 'w') as fp:
+            json.dump(bench, fp, indent=4)
+    if compare_to:
+        with open(compare_to) as fp:
+            compare(bench, json.load(fp))
+
+
+class ArgParseFormatter(argparse.RawDescriptionHelpFormatter,
+                        argparse.ArgumentDefaultsHelpFormatter):
+    pass
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=ArgParseFormatter)
+    parser.add_argument('--clients', help='Number of concurrent clients', type=int, default=8)
+    parser.add_argument('--duration', help='Seconds to load each route', type=float, default=10.)
+    parser.add_argument('--nsim', help='Number of sims in the submitted selection', type=int, default=100)
+    parser.add_argument('--latency', help='Mean fake Globus call latency, in seconds', type=float, default=0.05)
+    parser.add_argument('--error-rate', help='Fraction of fake Globus calls that fail with a 503', type=float, default=0.)
+    parser.add_argument('--manifest', help='Backend manifest (simulations.json) to use instead of the configured one')
+    parser.add_argument('--routes', help='Routes to load', nargs='+', choices=ROUTES, default=ROUTES)
+    parser.add_argument('-o', '--out', help='Output JSON file for the results')
+    parser.add_argument('--compare', help='Previous results JSON to compare against', dest='compare_to')
+
+    args = parser.parse_args()
+    args = vars(args)
+
+    main(**args)
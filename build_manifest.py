@@ -3,7 +3,26 @@
 Scan the file system to build a JSON simulations manifest for the data portal.
 
 In detail, builds two manifests: one for the website/table that groups small
-sims into sets of 100, and one exploded manifest for the backend.
+sims into sets of 100, and one exploded manifest for the backend.  Also writes
+a per-directory file index that the portal uses to generate HTTPS file lists.
+
+Each build has a content-hash version.  Sim IDs are kept stable across builds,
+and if a previous build is present in the output dir, a delta against it is
+written (rows added, removed, and changed, by per-row content hash), so that
+the portal and the browser can patch their copy instead of reloading it all.
+
+Also writes a rollup cube of file counts and sizes over (sim family,
+cosmology, product, ftype, redshift), which the portal serves totals from.
+
+Scans are checkpointed to a journal, so a restarted run resumes where the last
+one stopped (use --restart to start over).  Sims that fail to scan are listed
+in an error report, rather than aborting the run, and keep their entries from
+the previous build (or are left out, if they're new).
+
+Sims are scanned concurrently under a metadata-load governor, which adapts
+the number of in-flight file system operations (additive increase,
+multiplicative decrease) to keep their latency under --target-latency, and
+optionally caps the operation rate with --max-ops.
 
 Usage
 -----
@@ -12,11 +31,17 @@ $ ./build_manifest.py --help
 
 import json
 import argparse
+import hashlib
 from pathlib import Path
 import os
 import copy
 import re
+import time
+import traceback
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from threading import Condition
 
 from tqdm import tqdm
 # These are needed to read the header
@@ -27,52 +52,214 @@ import asdf
 # ICs don't quite fall in the redshift-product-ftype hierarchy
 # MergerTest doesn't have the standard set of redshifts
 
+# Products with redshifts=False (the light cones) have their ftype dirs
+# directly under the product dir, and rows hold them as {ftype: [nfile, du]}
+# instead of {z: {ftype: [nfile, du]}}.
+
 #DEFAULT_ROOT = '/mnt/ceph/users/lgarrison/AbacusSummit'
-DEFAULT_ROOT = os.environ['CFS'] + '/desi/cosmosim/Abacus'
+DEFAULT_ROOT = os.environ.get('CFS', '') + '/desi/cosmosim/Abacus'
 DEFAULT_PRODUCTS = dict(halos=dict(path='{}/halos', ftypes=('halo_info','halo_rv_A','halo_pid_A','field_rv_A','field_pid_A')),
                         cleaning=dict(path='cleaning/{}', ftypes=('cleaned_halo_info','cleaned_rvpid')),
                         power=dict(path='power/{}', ftypes=('AB','pack9')),
+                        lightcones=dict(path='{}/lightcones', ftypes=('heal','pid','rv'), redshifts=False),
                         )
-                        #lightcones=('heal','pid','rv')  # TODO
 DEFAULT_SIM_PATS = ('AbacusSummit_*/', 'small/AbacusSummit_*/')
 DEFAULT_OUTDIR = 'web/portal/static/data/'
+DEFAULT_FILE_INDEX = 'web/portal/data/files.index'
+DEFAULT_JOURNAL = 'build_manifest.journal'
+DEFAULT_ERRORS = 'build_manifest.errors.json'
+DEFAULT_TARGET_LATENCY = 0.05  # seconds per metadata op
+DEFAULT_MAX_CONCURRENCY = 16
+
+ROLLUP_AXES = ('family', 'cosmology', 'product', 'ftype', 'redshift')
+SIM_NAME_RE = re.compile(r'AbacusSummit_(?P<family>.+)_(?P<cosmology>c\d+)_ph\d+')
 
 DEFAULT_REDSHIFTS = [0.1, 0.15, 0.2, 0.25, 0.3, 0.35, 0.4, 0.45, 0.5, 0.575, 0.65, 0.725, 0.8, 0.875, 0.95, 1.025, 1.1, 1.175, 1.25, 1.325, 1.4, 1.475, 1.55, 1.625, 1.7, 1.85, 2.0, 2.25, 2.5, 2.75, 3.0, 5.0, 8.0]
 
-def find_products(simdir, products, redshifts):
+class ScanError(Exception):
+    '''A sim that can't be scanned, e.g. an unreadable file or unexpected layout.'''
+    pass
+
+
+class MetadataGovernor:
+    '''Admission control for file system metadata operations.
+
+    Each operation run through `call()` is timed.  Every `window` seconds,
+    the 90th percentile latency of the window's operations is compared to
+    `target_latency`: below it, the allowed concurrency goes up by one;
+    above it, the concurrency is halved (AIMD).  If `max_ops` is given, the
+    operation rate is also capped with a token bucket.
+    '''
+    def __init__(self, target_latency=DEFAULT_TARGET_LATENCY, max_ops=None,
+                 max_concurrency=DEFAULT_MAX_CONCURRENCY, window=1.):
+        self.target_latency = target_latency
+        self.max_ops = max_ops
+        self.max_concurrency = max_concurrency
+        self.window = window
+
+        self.concurrency = min(4, max_concurrency)
+        self._cond = Condition()
+        self._active = 0
+        self._tokens = 1.
+        self._last_token = time.monotonic()
+
+        self._window_start = time.monotonic()
+        self._latencies = []
+
+        # metrics
+        self.nop = 0
+        self.ops_per_s = 0.
+        self.latency_p90 = 0.
+
+    def call(self, fn, *args, **kwargs):
+        '''Run the metadata operation `fn(*args, **kwargs)` under the limits.'''
+        with self._admitted():
+            return fn(*args, **kwargs)
+
+    @contextmanager
+    def _admitted(self):
+        with self._cond:
+            while self._active >= self.concurrency:
+                self._cond.wait()
+            self._active += 1
+        t = time.perf_counter()
+        try:
+            self._take_token()
+            t = time.perf_counter()
+            yield
+        finally:
+            dt = time.perf_counter() - t
+            with self._cond:
+                self._active -= 1
+                self._record(dt)
+                self._cond.notify_all()
+
+    def _take_token(self):
+        while self.max_ops:
+            with self._cond:
+                now = time.monotonic()
+                self._tokens = min(1., self._tokens + (now - self._last_token)*self.max_ops)
+                self._last_token = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens)/self.max_ops
+            time.sleep(wait)
+
+    def _record(self, dt):
+        '''Log one op's latency and, at the end of a window, adjust. Holds the lock.'''
+        self.nop += 1
+        self._latencies += [dt]
+
+        elapsed = time.monotonic() - self._window_start
+        if elapsed < self.window:
+            return
+
+        lat = sorted(self._latencies)
+        self.latency_p90 = lat[int(0.9*(len(lat) - 1))]
+        self.ops_per_s = len(lat)/elapsed
+        if self.latency_p90 > self.target_latency:
+            self.concurrency = max(1, self.concurrency//2)
+        else:
+            self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+
+        self._latencies = []
+        self._window_start = time.monotonic()
+
+    def stats(self):
+        '''Return a snapshot of the governor metrics.'''
+        with self._cond:
+            return dict(nop=self.nop, ops_per_s=self.ops_per_s,
+                        latency_p90_s=self.latency_p90, concurrency=self.concurrency)
+
+    def postfix(self):
+        '''Live stats for the progress bar.'''
+        return (f'{self.ops_per_s:.0f} ops/s, p90 {self.latency_p90*1e3:.1f} ms, '
+                f'concurrency {self.concurrency}')
+
+
+def _call(fn, *args, **kwargs):
+    return fn(*args, **kwargs)
+
+
+def _scan_dir(path, op=_call):
+    '''List a directory in one os.scandir() pass. Returns the sorted subdir
+    names and the sorted [name, size] of the files. Only the files cost a
+    stat; the DirEntry type info usually comes free with the listing.
+    '''
+    with op(os.scandir, path) as it:
+        entries = op(list, it)
+
+    subdirs, files = [], []
+    for entry in entries:
+        if entry.is_dir():
+            subdirs += [entry.name]
+        else:
+            files += [[entry.name, op(entry.stat).st_size]]
+
+    return sorted(subdirs), sorted(files)
+
+
+def find_products(simdir, products, redshifts, file_index=None, governor=None):
+    '''Scan one sim. If `file_index` is a list, append one
+    (relative dir, [[name, size], ...]) entry per ftype directory.
+    If `governor` is given, every file system operation goes through it.
+    '''
+    op = governor.call if governor else _call
     parent, child = simdir
     j = {}
     header = {}
+
+    def scan_ftypes(prod, dpath, subdirs):
+        '''Aggregate each ftype dir of `prod` in `dpath` to [nfile, du].'''
+        res = {}
+        for ftype in products[prod]['ftypes']:
+            if ftype not in subdirs:
+                continue
+            fpath = dpath / ftype
+            _, files = _scan_dir(fpath, op)
+            nfile = len(files)
+            du = sum(f[1] for f in files)
+            res[ftype] = [nfile,du]  # j['halos']['0.100']['halo_info']
+
+            if file_index is not None:
+                file_index.append((str(fpath.relative_to(parent)), files))
+
+            if not header:
+                try:
+                    fn = next(f[0] for f in files if f[0].endswith('.asdf'))
+                    with op(asdf.open, fpath / fn) as af:
+                        for k in ('BoxSize','SimComment','ParticleMassHMsun'):
+                            header[k] = af['header'][k]
+
+                        header['PPD'] = int(round(af['header']['NP']**(1/3)))
+                except Exception as e:
+                    raise ScanError(f'Failed in: {fpath}') from e
+        return res
+
     for prod in products:
-        j[prod] = {}  # j['halos']
         pdir = parent / products[prod]['path'].format(child)
-        for zdir in sorted(pdir.glob('z*/')):
-            zval = zdir.name[1:]
-            zval = float(zval)
-            assert zval in DEFAULT_REDSHIFTS
-            if zval not in redshifts:
-                continue
-            j[prod][zval] = {}  # j['halos']['0.100']
-            for ftype in products[prod]['ftypes']:
-                if (fpath:=zdir/ftype).is_dir():
-                    du = [fn.stat().st_size for fn in fpath.iterdir()]
-                    nfile = len(du)
-                    du = sum(du)
-                    j[prod][zval][ftype] = [nfile,du]  # j['halos']['0.100']['halo_info']
-
-                    if not header:
-                        try:
-                            with asdf.open(next(fpath.glob('*.asdf'))) as af:
-                                for k in ('BoxSize','SimComment','ParticleMassHMsun'):
-                                    header[k] = af['header'][k]
-
-                                header['PPD'] = int(round(af['header']['NP']**(1/3)))
-                        except Exception as e:
-                            raise Exception(f'Failed in: {fpath}') from e
-                            
-            # this z not on disk?
-            if not j[prod][zval]:
-                del j[prod][zval]
+        try:
+            subdirs, _ = _scan_dir(pdir, op)
+        except FileNotFoundError:
+            continue
+
+        if not products[prod].get('redshifts', True):
+            j[prod] = scan_ftypes(prod, pdir, subdirs)  # j['lightcones']['heal']
+        else:
+            j[prod] = {}  # j['halos']
+            for zname in subdirs:
+                if not zname.startswith('z'):
+                    continue
+                zval = float(zname[1:])
+                if zval not in DEFAULT_REDSHIFTS:
+                    raise ScanError(f'Unexpected redshift directory: {pdir / zname}')
+                if zval not in redshifts:
+                    continue
+                zsubdirs, _ = _scan_dir(pdir / zname, op)
+                # this z not on disk?
+                if ftypes := scan_ftypes(prod, pdir / zname, zsubdirs):
+                    j[prod][zval] = ftypes  # j['halos']['0.100']
         # no halos?
         if not j[prod]:
             del j[prod]
@@ -84,6 +271,16 @@ def find_products(simdir, products, redshifts):
     return j
 
 
+def _add_du(dst, src):
+    '''Add each ftype's [nfile, du] in `src` to `dst`.'''
+    for ftype in src:
+        if ftype not in dst:
+            dst[ftype] = list(src[ftype])  # init if necessary
+            continue
+        dst[ftype][0] += src[ftype][0]
+        dst[ftype][1] += src[ftype][1]
+
+
 def _collapsed_manifest(manifest, ngroup=100, nsingle=10):
     '''Group the small sims in sets of 100.
     '''
@@ -118,13 +315,11 @@ def _collapsed_manifest(manifest, ngroup=100, nsingle=10):
                 for p in manifest['products']:
                     if p not in row:
                         continue
+                    if not manifest['products'][p].get('redshifts', True):
+                        _add_du(grouprow.setdefault(p, {}), row[p])
+                        continue
                     for z in row[p]:
-                        if z not in grouprow[p]:
-                            grouprow[p][z] = copy.deepcopy(row[p][z])  # init if necessary
-                            continue
-                        for ftype in row[p][z]:
-                            grouprow[p][z][ftype][0] += row[p][z][ftype][0]
-                            grouprow[p][z][ftype][1] += row[p][z][ftype][1]
+                        _add_du(grouprow.setdefault(p, {}).setdefault(z, {}), row[p][z])
                             
             grouprow['all_ids'] += [row['id']]
             
@@ -152,60 +347,457 @@ def _collapsed_manifest(manifest, ngroup=100, nsingle=10):
 #                row[p][z][ftype][1] = f'{row[p][z][ftype][1]:.3g}'
     
 
-def main(sim_pats=DEFAULT_SIM_PATS,
-         products=DEFAULT_PRODUCTS,
-         root=DEFAULT_ROOT,
-         out=DEFAULT_OUTDIR,
-         redshifts=DEFAULT_REDSHIFTS,
-         compact=False,
-        ):
+class Journal:
+    '''Append-only JSON-lines log of scanned sims, so that an interrupted scan
+    can resume. The first line holds the scan parameters; a journal from a
+    scan with different parameters is ignored. Flushed to disk every
+    `checkpoint_every` sims.
+    '''
+    def __init__(self, fn, params, checkpoint_every=20):
+        self.fn = Path(fn)
+        self.params = json.loads(json.dumps(params))
+        self.checkpoint_every = checkpoint_every
+        self._fp = None
+        self._n = 0
+
+    def load(self):
+        '''Return {slug: (row, files)} for the sims done in a previous run.'''
+        done = {}
+        try:
+            with open(self.fn, encoding='utf-8') as fp:
+                lines = iter(fp)
+                if json.loads(next(lines, 'null')) != {'params': self.params}:
+                    print(f'Ignoring journal {self.fn} from a scan with different parameters')
+                    return {}
+                for line in lines:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break  # torn write at the end of the last run
+                    done[entry['sim']] = (entry['row'], entry['files'])
+        except FileNotFoundError:
+            pass
+        return done
+
+    def open(self, resume=True):
+        '''Start appending, either after the existing entries or from scratch.'''
+        done = self.load() if resume else {}
+
+        # rewrite the good entries, dropping any torn tail, to a temp file
+        # that replaces the journal only once it's on disk
+        tmp = self.fn.with_name(self.fn.name + '.tmp')
+        with open(tmp, 'w', encoding='utf-8') as fp:
+            fp.write(json.dumps({'params': self.params}) + '\n')
+            for slug, (row, files) in done.items():
+                fp.write(json.dumps({'sim': slug, 'row': row, 'files': files}) + '\n')
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp, self.fn)
+
+        self._fp = open(self.fn, 'a', encoding='utf-8')
+        return done
+
+    def record(self, slug, row, files):
+        self._fp.write(json.dumps({'sim': slug, 'row': row, 'files': files}) + '\n')
+        self._n += 1
+        if self._n % self.checkpoint_every == 0:
+            self.checkpoint()
+
+    def checkpoint(self):
+        self._fp.flush()
+        os.fsync(self._fp.fileno())
+
+    def close(self):
+        self._fp.close()
+
+    def remove(self):
+        self.fn.unlink(missing_ok=True)
+
+
+def _row_from_json(row, products):
+    '''Undo the JSON conversion of a journaled row's redshift keys to strings.'''
+    if row:
+        for prod in products:
+            if prod in row and products[prod].get('redshifts', True):
+                row[prod] = {float(z):v for z,v in row[prod].items()}
+    return row
+
+
+def scan_sims(root, sim_pats=DEFAULT_SIM_PATS,
+              products=DEFAULT_PRODUCTS,
+              redshifts=DEFAULT_REDSHIFTS,
+              file_index=None,
+              journal=None,
+              errors=None,
+              resume=True,
+              governor=None,
+             ):
+    '''Run find_products() on every sim matching `sim_pats` under `root`.
+    Returns the list of manifest rows, with IDs assigned.
+
+    If `journal` is a path, each scanned sim is logged there, and sims logged
+    by a previous run are not rescanned (unless `resume` is False). If
+    `errors` is a list, sims that fail to scan are skipped and recorded
+    there; otherwise the error is raised. If a MetadataGovernor is given,
+    sims are scanned concurrently under its control; otherwise serially.
+    '''
     root = Path(root)
-    out = Path(out)
-    
+
     sims = []
     for pat in sim_pats:
         sims += root.glob(pat)
+    sims = {str(Path(sim).relative_to(root)): Path(sim).name for sim in sims}
+
+    done = {}
+    if journal:
+        journal = Journal(journal, dict(root=str(root), sim_pats=sim_pats,
+                                        products=products, redshifts=redshifts))
+        done = journal.open(resume=resume)
+        if done:
+            print(f'Resuming: {len(done)} sims already scanned')
     
-    rows = []  # d['AbacusSummit_base_c000_ph000']['halos']['z0.100']['halo_info']
-    
-    #sims = [sim for i,sim in enumerate(sorted(sims)) if i == 0 or i > 2050]
-    for sim in tqdm(sorted(sims)):
-        sim = Path(sim)
-        slug = str(sim.relative_to(root))
-        
-        row = find_products((root, slug), products, redshifts)
+    def scan_one(slug):
+        sim_files = []
+        try:
+            row = find_products((root, slug), products, redshifts,
+                                file_index=sim_files, governor=governor)
+        except Exception as e:
+            if errors is None:
+                raise
+            return slug, e, traceback.format_exc()
         if row:
-            row.update({'name': sim.name,
+            row.update({'name': sims[slug],
                         'root': slug,
                         })
+        return slug, row, sim_files
+
+    results = {slug: (_row_from_json(row, products), sim_files)
+               for slug, (row, sim_files) in done.items() if slug in sims}
+    todo = sorted(set(sims) - set(results))
+
+    #sims = [sim for i,sim in enumerate(sorted(sims)) if i == 0 or i > 2050]
+    pool = ThreadPoolExecutor(max_workers=governor.max_concurrency if governor else 1)
+    try:
+        pbar = tqdm(total=len(sims), initial=len(results))
+        for future in as_completed([pool.submit(scan_one, slug) for slug in todo]):
+            slug, row, sim_files = future.result()
+            pbar.update()
+            if governor:
+                pbar.set_postfix_str(governor.postfix(), refresh=False)
+
+            if isinstance(row, Exception):
+                errors += [{'sim': slug, 'error': repr(row), 'traceback': sim_files}]
+                tqdm.write(f'Quarantined {slug}: {row!r}')
+                continue
+            if journal:
+                journal.record(slug, row, sim_files)
+            results[slug] = (row, sim_files)
+        pbar.close()
+    finally:
+        # on error, don't wait for the rest of the tree to be scanned
+        pool.shutdown(cancel_futures=True)
+        if journal:
+            journal.close()
+    if errors:
+        errors.sort(key=lambda e: e['sim'])
+
+    rows = []  # d['AbacusSummit_base_c000_ph000']['halos']['z0.100']['halo_info']
+    for slug in sorted(results):
+        row, sim_files = results[slug]
+        if row:
             rows += [row]
+        if file_index is not None:
+            file_index += [tuple(f) for f in sim_files]
     
     # add the index to each row
     for uid,row in enumerate(rows):
         row['id'] = uid
-            
+
+    return rows
+
+
+def make_manifest(rows, products=DEFAULT_PRODUCTS):
+    '''Assemble the full manifest from the rows.'''
     # figure out which z we actually have any data for
-    redshifts = list(sorted(set(sum((sum( (list(row.get(prod,[])) for row in rows),[]) for prod in products),[] ))))
+    zprods = [prod for prod in products if products[prod].get('redshifts', True)]
+    redshifts = list(sorted(set(sum((sum( (list(row.get(prod,[])) for row in rows),[]) for prod in zprods),[] ))))
     print(len(redshifts), redshifts)
     
     manifest = {'data':rows,
                 'redshifts':redshifts,
                 # TODO
                 'products':products}
-    
-    # Collapse any groups of sims
-    collapsed_manifest = _collapsed_manifest(manifest)
-    
+
+    return manifest
+
+
+def make_rollup(manifest):
+    '''Sum the manifest rows into a cube of [nfile, du] over ROLLUP_AXES,
+    e.g. ('base', 'c000', 'halos', 'halo_info', 0.5). Products without
+    redshifts have redshift None. Stored sparsely: the labels of each axis,
+    then for each non-empty cell its label index on each axis, nfile and du,
+    as parallel arrays.
+    '''
+    cells = defaultdict(lambda: [0,0])
+    for row in manifest['data']:
+        if m := SIM_NAME_RE.match(row['name']):
+            family, cosmology = m['family'], m['cosmology']
+        else:
+            family, cosmology = row['name'], None
+        for prod in manifest['products']:
+            if prod not in row:
+                continue
+            if manifest['products'][prod].get('redshifts', True):
+                zrows = row[prod]
+            else:
+                zrows = {None: row[prod]}
+            for z in zrows:
+                for ftype, du in zrows[z].items():
+                    cell = cells[family, cosmology, prod, ftype, z]
+                    cell[0] += du[0]
+                    cell[1] += du[1]
+
+    # None sorts last
+    axes = {axis: sorted({key[i] for key in cells}, key=lambda v: (v is None, v))
+            for i,axis in enumerate(ROLLUP_AXES)}
+    index = {axis: {v:i for i,v in enumerate(axes[axis])} for axis in ROLLUP_AXES}
+    keys = sorted(cells, key=lambda key: [index[axis][v] for axis,v in zip(ROLLUP_AXES, key)])
+
+    return {'version': manifest.get('version'),
+            'axes': axes,
+            'index': [[index[axis][key[i]] for key in keys] for i,axis in enumerate(ROLLUP_AXES)],
+            'nfile': [cells[key][0] for key in keys],
+            'du': [cells[key][1] for key in keys],
+            }
+
+
+def _row_hash(row):
+    '''Content hash of a manifest row, ignoring its ID.'''
+    row = {k:v for k,v in row.items() if k not in ('id','hash')}
+    # round trip so that float redshift keys are hashed as their JSON strings
+    s = json.dumps(json.loads(json.dumps(row)), sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(s.encode()).hexdigest()[:16]
+
+
+def _assign_ids(rows, previous=None):
+    '''Keep the IDs of sims that were in the previous manifest, so that IDs
+    (and thus deltas and user selections) stay valid across builds. New sims
+    get new IDs, above the high-water mark `next_id` of the previous
+    manifest, so that the ID of a removed sim is never reused.
+    Returns the new high-water mark.
+    '''
+    if not previous:
+        return max((row['id'] for row in rows), default=-1) + 1
+    old_ids = {row['name']:row['id'] for row in previous['data']}
+    next_id = max(previous.get('next_id', 0), max(old_ids.values(), default=-1) + 1)
+    for row in rows:
+        if row['name'] in old_ids:
+            row['id'] = old_ids[row['name']]
+        else:
+            row['id'] = next_id
+            next_id += 1
+    return next_id
+
+
+def _add_version(manifest, version):
+    '''Add per-row content hashes and the build version to a manifest.'''
+    for row in manifest['data']:
+        row['hash'] = _row_hash(row)
+    manifest['version'] = version
+
+
+def _manifest_version(manifest):
+    '''The build version: a hash of the backend manifest contents.'''
+    s = json.dumps([manifest['redshifts'], manifest['products'],
+                    [(row['id'], _row_hash(row)) for row in manifest['data']]],
+                   separators=(',', ':'))
+    return hashlib.sha1(s.encode()).hexdigest()[:12]
+
+
+def make_delta(old, new):
+    '''Compute the delta from manifest `old` to `new`, by row name. Applying
+    it means: drop the removed rows, take the added and changed rows, and
+    put the rows in the given order. Returns None if `old` is unversioned.
+    '''
+    if not old or 'version' not in old:
+        return None
+    old_hashes = {row['name']:row.get('hash') for row in old['data']}
+    new_names = {row['name'] for row in new['data']}
+
+    delta = {'from': old['version'],
+             'to': new['version'],
+             'added': [row for row in new['data'] if row['name'] not in old_hashes],
+             'changed': [row for row in new['data'] if row['name'] in old_hashes
+                         and old_hashes[row['name']] != row['hash']],
+             'removed': [name for name in old_hashes if name not in new_names],
+             'order': [row['name'] for row in new['data']],
+             'redshifts': new['redshifts'],
+             'products': new['products'],
+             }
+    return delta
+
+
+def _load_json(fn):
+    try:
+        with open(fn, encoding='utf-8') as fp:
+            return json.load(fp)
+    except FileNotFoundError:
+        return None
+
+
+def _write_json(fn, obj, **jsargs):
+    '''Write JSON atomically, so the portal never sees a partial file.'''
+    fn = Path(fn)
+    tmp = fn.with_name(fn.name + '.tmp')
+    with open(tmp, 'w', encoding='utf-8') as fp:
+        json.dump(obj, fp, **jsargs)
+    os.replace(tmp, fn)
+
+
+def write_manifests(manifest, collapsed_manifest, out, compact=False, deltas=None, rollup=None):
+    '''Write the backend and table manifests to the `out` directory, along
+    with their deltas and the rollup cube. Existing delta files are left
+    alone if `deltas` is None, and removed if a delta is None. The version
+    file is written last.
+    '''
+    out = Path(out)
+
     if compact:
         jsargs = dict(separators=(',', ':'))
     else:
         jsargs = dict(indent=4)
-    s = json.dumps(manifest, indent=4)
-    #print(s)
-    with open(out / "simulations.json", 'w', encoding='utf-8') as fp:
-        fp.write(s)
-    with open(out / "simulations.table.json", 'w', encoding='utf-8') as fp:
-        json.dump(collapsed_manifest, fp, **jsargs)
+    _write_json(out / "simulations.json", manifest, indent=4)
+    _write_json(out / "simulations.table.json", collapsed_manifest, **jsargs)
+
+    for fn, delta in zip(("simulations.delta.json", "simulations.table.delta.json"),
+                         deltas or ()):
+        if delta:
+            _write_json(out / fn, delta, separators=(',', ':'))
+        elif (out / fn).exists():
+            # stale delta from an older build
+            (out / fn).unlink()
+
+    if rollup:
+        _write_json(out / "simulations.rollup.json", rollup, separators=(',', ':'))
+
+    if 'version' in manifest:
+        with open(out / "simulations.version.tmp", 'w', encoding='utf-8') as fp:
+            fp.write(manifest['version'] + '\n')
+        os.replace(out / "simulations.version.tmp", out / "simulations.version")
+
+
+def main(sim_pats=DEFAULT_SIM_PATS,
+         products=DEFAULT_PRODUCTS,
+         root=DEFAULT_ROOT,
+         out=DEFAULT_OUTDIR,
+         redshifts=DEFAULT_REDSHIFTS,
+         compact=False,
+         file_index=DEFAULT_FILE_INDEX,
+         journal=DEFAULT_JOURNAL,
+         errors=DEFAULT_ERRORS,
+         restart=False,
+         target_latency=DEFAULT_TARGET_LATENCY,
+         max_ops=None,
+         max_concurrency=DEFAULT_MAX_CONCURRENCY,
+        ):
+    out = Path(out)
+    previous = _load_json(out / "simulations.json")
+    previous_table = _load_json(out / "simulations.table.json")
+
+    files = []  # [('AbacusSummit_base_c000_ph000/halos/z0.100/halo_info', [['halo_info_000.asdf', 123], ...]), ...]
+    scan_errors = []
+    governor = MetadataGovernor(target_latency=target_latency, max_ops=max_ops,
+                                max_concurrency=max_concurrency)
+    t = time.perf_counter()
+    rows = scan_sims(root, sim_pats, products, redshifts, file_index=files,
+                     journal=journal, errors=scan_errors, resume=not restart,
+                     governor=governor)
+    stats = governor.stats()
+    print(f'{stats["nop"]} metadata ops in {time.perf_counter() - t:.1f} s; '
+          f'last p90 latency {stats["latency_p90_s"]*1e3:.1f} ms, concurrency {stats["concurrency"]}')
+
+    _carry_forward(scan_errors, rows, files, previous, products, file_index)
+
+    # always (re)write the report, so a stale one isn't mistaken for this run's
+    with open(errors, 'w', encoding='utf-8') as fp:
+        json.dump(scan_errors, fp, indent=4)
+    if scan_errors:
+        ncarried = sum(e.get('carried_forward', False) for e in scan_errors)
+        print(f'{len(scan_errors)} sims failed to scan: {ncarried} kept from the previous build, '
+              f'{len(scan_errors) - ncarried} left out of the manifest; see {errors}')
+    next_id = _assign_ids(rows, previous)
+
+    manifest = make_manifest(rows, products)
+    
+    # Collapse any groups of sims
+    collapsed_manifest = _collapsed_manifest(manifest)
+    manifest['next_id'] = next_id
+
+    version = _manifest_version(manifest)
+    _add_version(manifest, version)
+    _add_version(collapsed_manifest, version)
+    if previous and previous.get('version') == version:
+        # nothing changed; keep the delta from the last real change
+        deltas = None
+    else:
+        deltas = (make_delta(previous, manifest), make_delta(previous_table, collapsed_manifest))
+        if deltas[0]:
+            d = deltas[0]
+            print(f'Delta {d["from"]} -> {d["to"]}: {len(d["added"])} added, '
+                  f'{len(d["changed"])} changed, {len(d["removed"])} removed')
+    
+    # the file index goes first, since the manifest version file announces the build
+    write_file_index(files, file_index)
+
+    rollup = make_rollup(manifest)
+
+    write_manifests(manifest, collapsed_manifest, out, compact=compact, deltas=deltas, rollup=rollup)
+
+    # the scan is published; the next build starts fresh
+    Journal(journal, {}).remove()
+
+
+def _carry_forward(scan_errors, rows, files, previous, products, file_index):
+    '''For each sim that failed to scan but was in the previous build, keep
+    its previous row and file index entries, so that a transient error isn't
+    published as a removal. Marks those errors as carried forward.
+    '''
+    if not previous:
+        return
+    old_rows = {row['root']:row for row in previous['data']}
+    failed = [e for e in scan_errors if e['sim'] in old_rows]
+    if not failed:
+        return
+
+    for e in failed:
+        row = {k:v for k,v in old_rows[e['sim']].items() if k != 'hash'}
+        rows += [_row_from_json(row, products)]
+        e['carried_forward'] = True
+    rows.sort(key=lambda row: row['root'])
+
+    prefixes = tuple(products[prod]['path'].format(e['sim']) + '/'
+                     for e in failed for prod in products)
+    try:
+        with open(file_index, encoding='utf-8') as fp:
+            for line in fp:
+                if line.startswith(prefixes):
+                    path, listing = line.rstrip('\n').split('\t', 1)
+                    files += [(path, json.loads(listing))]
+    except FileNotFoundError:
+        pass
+
+
+def write_file_index(files, fn):
+    '''Write the file index: one line per directory, of the form
+    "<relative dir>\t<JSON list of [name, size]>". The portal only keeps
+    the line offsets in memory and reads the listings on demand.
+    '''
+    fn = Path(fn)
+    tmp = fn.with_name(fn.name + '.tmp')
+    with open(tmp, 'w', encoding='utf-8') as fp:
+        for path, listing in files:
+            fp.write(path + '\t' + json.dumps(listing, separators=(',', ':')) + '\n')
+    os.replace(tmp, fn)
 
 
 class ArgParseFormatter(argparse.RawDescriptionHelpFormatter,
@@ -216,6 +808,13 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description=__doc__, formatter_class=ArgParseFormatter)
     #parser.add_argument('sims', help='Simulation', nargs='+', metavar='SIM')
     parser.add_argument('-o','--out', help='Output dir for JSON', default=DEFAULT_OUTDIR)
+    parser.add_argument('--file-index', help='Output file for the per-directory file index', default=DEFAULT_FILE_INDEX)
+    parser.add_argument('--journal', help='Scan checkpoint journal, for resuming an interrupted scan', default=DEFAULT_JOURNAL)
+    parser.add_argument('--errors', help='Output JSON report of sims that failed to scan', default=DEFAULT_ERRORS)
+    parser.add_argument('--restart', help='Ignore any existing journal and rescan everything', action='store_true')
+    parser.add_argument('--target-latency', help='Target p90 latency of file system metadata ops, in seconds', type=float, default=DEFAULT_TARGET_LATENCY)
+    parser.add_argument('--max-ops', help='Ceiling on file system metadata ops per second', type=float)
+    parser.add_argument('--max-concurrency', help='Max concurrent file system metadata ops', type=int, default=DEFAULT_MAX_CONCURRENCY)
 
     args = parser.parse_args()
     args = vars(args)
@@ -2,18 +2,61 @@ from flask import Flask
 import json
 
 from portal.database import Database
+from portal.fileindex import FileIndex
+from portal.manifest import ManifestWatcher
+from portal.pages import PageCache
+from portal.plans import PlanCache
+from portal.poller import TransferPoller
+from portal.ratelimit import GlobusLimiter
+from portal.rollup import Rollup
+from portal.stats import StatsReporter
 
 __author__ = 'Lehman Garrison <lgarrison@flatironinstitute.org>'
 
 app = Flask(__name__)
 app.config.from_pyfile('portal.conf')
-app.config['TEMPLATES_AUTO_RELOAD'] = True
+# Pre-rendered pages are only re-rendered explicitly, so don't re-stat templates
+app.config['TEMPLATES_AUTO_RELOAD'] = not app.config['PRERENDER_PAGES']
 
 database = Database(app)
+globus_limiter = GlobusLimiter.from_config(app.config)
+stats_reporter = StatsReporter(app)
+stats_reporter.register('globus_limiter', globus_limiter.stats)
+app.before_request(stats_reporter.check)
+pages = PageCache(app)
+transfer_plans = PlanCache(app.config['TRANSFER_PLAN_CACHE_SIZE'],
+                           app.config['TRANSFER_PLAN_CACHE_ITEMS'])
+stats_reporter.register('transfer_plans', transfer_plans.stats)
 
 with open(app.config['PORTAL_ROOT'] + app.config['DATASETS']) as f:
     datasets = json.load(f)
 with open(app.config['PORTAL_ROOT'] + app.config['DESCRIPTIONS']) as f:
     dataset_desc = json.load(f)
 
+file_index = FileIndex(app.config['PORTAL_ROOT'] + app.config['FILE_INDEX'])
+rollup = Rollup(app.config['PORTAL_ROOT'] + app.config['DATASETS_ROLLUP'])
+
+if app.config['TRANSFER_POLL_INTERVAL']:
+    transfer_poller = TransferPoller(app, database, globus_limiter)
+    # start with the first request, so that processes that only import the
+    # app (e.g. the debug reloader's parent) don't poll
+    app.before_request(transfer_poller.ensure_started)
+
+
+def swap_datasets(new_datasets):
+    """
+    Replace the backend manifest in place, so that every module sees the
+    new one, and re-render the pages that depend on it.
+    """
+    datasets.update(new_datasets)
+    file_index.reset()
+    transfer_plans.clear()
+    rollup.load()
+    pages.render_all()
+
+
+manifest_watcher = ManifestWatcher(app, datasets, swap_datasets)
+app.before_request(manifest_watcher.check)
+
+
 import portal.views
@@ -1,8 +1,33 @@
 """Manage access to the database."""
 
 import sqlite3
+import time
+from contextlib import closing
 from flask import g
 
+SCHEMA = """
+create table if not exists transfer (
+    id integer primary key autoincrement,
+    identity_id text not null,
+    task_id text not null unique,
+    label text,
+    submitted text not null default current_timestamp,
+    status text not null default 'ACTIVE',
+    files integer,
+    files_transferred integer,
+    bytes_transferred integer,
+    completion_time text,
+    updated text
+);
+create index if not exists transfer_identity on transfer (identity_id);
+create table if not exists poller_lease (
+    id integer primary key check (id = 0),
+    owner text,
+    expires real not null default 0
+);
+insert or ignore into poller_lease (id) values (0);
+"""
+
 
 class Database:
     """Database access."""
@@ -11,6 +36,9 @@ class Database:
         """Constructor."""
         self.app = app
 
+        with closing(self.connect_to_db()) as db:
+            db.executescript(SCHEMA)
+
         @app.teardown_appcontext
         def close_connection(exception):
             """Close database connection when finished handling request."""
@@ -65,3 +93,71 @@ class Database:
                              where identity_id = ?""",
                              [identity_id],
                              one=True)
+
+    def save_transfer(self, identity_id=None, task_id=None, label=None):
+        """Record a newly submitted transfer task."""
+        db = self.get_db()
+
+        db.execute("""insert or ignore into transfer (identity_id, task_id, label)
+                   values (?, ?, ?)""",
+                   (identity_id, task_id, label))
+        db.commit()
+
+    def load_transfers(self, identity_id):
+        """Load the transfers submitted by a user, newest first."""
+        return self.query_db("""select task_id, label, submitted, status, files,
+                             files_transferred, bytes_transferred,
+                             completion_time, updated
+                             from transfer where identity_id = ?
+                             order by id desc""",
+                             [identity_id])
+
+    def load_pending_task_ids(self, max_age_days=30):
+        """Load the IDs of recent tasks that have not reached a final state."""
+        rows = self.query_db("""select task_id from transfer
+                             where status not in ('SUCCEEDED', 'FAILED', 'EXPIRED')
+                             and submitted > datetime('now', ?)""",
+                             [f'-{max_age_days:d} days'])
+        return [row['task_id'] for row in rows]
+
+    def expire_transfers(self, max_age_days=30):
+        """
+        Mark the tasks older than `max_age_days` that never reached a final
+        state as EXPIRED, since their status is no longer polled. Returns
+        the number of tasks marked.
+        """
+        db = self.get_db()
+
+        cur = db.execute("""update transfer set status = 'EXPIRED'
+                         where status not in ('SUCCEEDED', 'FAILED', 'EXPIRED')
+                         and submitted <= datetime('now', ?)""",
+                         [f'-{max_age_days:d} days'])
+        db.commit()
+        return cur.rowcount
+
+    def acquire_poller_lease(self, owner, ttl):
+        """
+        Take or renew the lease that lets one process poll transfer status,
+        for `ttl` seconds. Returns whether `owner` holds it.
+        """
+        db = self.get_db()
+        now = time.time()
+
+        cur = db.execute("""update poller_lease set owner = ?, expires = ?
+                         where id = 0 and (owner = ? or expires < ?)""",
+                         [owner, now + ttl, owner, now])
+        db.commit()
+        return cur.rowcount == 1
+
+    def update_transfer_status(self, tasks):
+        """Store the status of each task in a list of Globus task documents."""
+        db = self.get_db()
+
+        db.executemany("""update transfer set status = ?, files = ?,
+                       files_transferred = ?, bytes_transferred = ?,
+                       completion_time = ?, updated = current_timestamp
+                       where task_id = ?""",
+                       [(t['status'], t['files'], t['files_transferred'],
+                         t['bytes_transferred'], t['completion_time'],
+                         t['task_id']) for t in tasks])
+        db.commit()
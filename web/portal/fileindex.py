@@ -0,0 +1,76 @@
+"""Lazy access to the per-directory file index written by build_manifest.py."""
+
+import json
+import os
+from threading import Lock
+
+
+class FileIndex:
+    """
+    Random access to the file index, by directory.
+
+    The index has one line per directory, of the form
+    "<relative dir>\t<JSON list of [name, size]>". Only the byte offset of
+    each line is kept in memory; listings are read from disk as needed.
+    """
+
+    def __init__(self, fn):
+        """Constructor. The index is not read until first use."""
+        self.fn = fn
+        self._offsets = None  # (file identity, {relative dir: byte offset})
+        self._lock = Lock()
+
+    def _index(self, fp, force=False):
+        """
+        Map of relative dir -> byte offset of its line in the open index
+        `fp`. The offsets are cached for the file they were read from, so a
+        rebuilt index (which build_manifest.py swaps in under a new inode)
+        is re-indexed before its offsets are used.
+        """
+        st = os.fstat(fp.fileno())
+        ident = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+        with self._lock:
+            if force or self._offsets is None or self._offsets[0] != ident:
+                offsets = {}
+                pos = 0
+                fp.seek(0)
+                for line in fp:
+                    path = line.split(b'\t', 1)[0].decode()
+                    offsets[path] = pos
+                    pos += len(line)
+                self._offsets = (ident, offsets)
+
+            return self._offsets[1]
+
+    def reset(self):
+        """Forget the offsets, e.g. after the index has been rebuilt."""
+        with self._lock:
+            self._offsets = None
+
+    def iter_files(self, dirs):
+        """
+        Generate (relative path, size) for every file in each of `dirs`, in
+        order. Directories that are not in the index are skipped.
+        """
+        with open(self.fn, 'rb') as fp:
+            offsets = self._index(fp)
+            for d in dirs:
+                d = str(d)
+                listing = self._read(fp, offsets, d)
+                if listing is None:
+                    # stale offsets, e.g. the index was rewritten in place
+                    offsets = self._index(fp, force=True)
+                    listing = self._read(fp, offsets, d)
+                for name, size in listing or ():
+                    yield d + '/' + name, size
+
+    @staticmethod
+    def _read(fp, offsets, d):
+        """Read the listing of `d`, or None if its line isn't at its offset."""
+        if d not in offsets:
+            return []
+        fp.seek(offsets[d])
+        path, tab, listing = fp.readline().partition(b'\t')
+        if not tab or path.decode() != d:
+            return None
+        return json.loads(listing)
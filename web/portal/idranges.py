@@ -0,0 +1,37 @@
+"""Compact "0-99,105,200-299" encoding of simulation ID selections.
+
+Kept free of Flask and portal imports, so it can be tested on its own.
+"""
+
+import re
+
+RANGE_RE = re.compile(r'(\d+)(?:-(\d+))?', re.ASCII)
+
+
+def decode_id_ranges(s, limit=None):
+    """
+    Decode a range string like "0-99,105,200-299" into a set of integer IDs.
+
+    The transfer page encodes selections this way (`encode_id_ranges()` in
+    scripts.jinja2). A plain comma-separated list of IDs is also a valid
+    range string, and overlapping ranges are merged.
+    Raises ValueError on malformed input, or on any ID >= `limit`, if given.
+    """
+    ids = set()
+    for tok in s.split(','):
+        tok = tok.strip()
+        if not tok:
+            continue
+        # not int(), which also takes "+5", "1_0", and non-ASCII digits
+        m = RANGE_RE.fullmatch(tok)
+        if not m:
+            raise ValueError(f'Invalid ID range: {tok}')
+        lo = int(m[1])
+        hi = int(m[2]) if m[2] is not None else lo
+        if hi < lo:
+            raise ValueError(f'Invalid ID range: {tok}')
+        if limit is not None and hi >= limit:
+            raise ValueError(f'ID out of range: {tok}')
+        ids.update(range(lo, hi + 1))
+
+    return ids
@@ -0,0 +1,37 @@
+"""Deferred imports of heavy dependencies, to keep worker start-up fast."""
+
+import importlib
+from threading import Lock
+
+
+class LazyModule:
+    """
+    Stand-in for module `name` that imports it on first attribute access.
+    Use as `mod.Thing`, not `from mod import Thing`.
+
+    The first import is done under a lock, so concurrent first requests
+    (or the poller thread) wait for a fully initialized module, rather than
+    seeing a half-executed one as they can with importlib's LazyLoader.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._lock = Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._module is None:
+                self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        # only called for attributes not set in __init__
+        return getattr(self._module or self._load(), attr)
+
+    def __repr__(self):
+        state = 'loaded' if self._module else 'not loaded'
+        return f'<lazy module {self._name!r} ({state})>'
+
+
+globus_sdk = LazyModule('globus_sdk')
@@ -0,0 +1,92 @@
+"""Pick up new manifest builds, by delta where possible."""
+
+import json
+import time
+from threading import Lock
+
+
+def apply_delta(manifest, delta):
+    """
+    Return a new manifest from applying a delta written by build_manifest.py:
+    drop the removed rows, take the added and changed rows, and order the
+    rows as in the new build.
+    """
+    rows = {row['name']: row for row in manifest['data']}
+    for name in delta['removed']:
+        del rows[name]
+    for row in delta['added'] + delta['changed']:
+        rows[row['name']] = row
+
+    return dict(manifest,
+                data=[rows[name] for name in delta['order']],
+                redshifts=delta['redshifts'],
+                products=delta['products'],
+                version=delta['to'],
+                )
+
+
+class ManifestWatcher:
+    """
+    Periodically check the manifest version file and, when a new build has
+    been published, load it into the portal: by applying the delta if it is
+    against our version, otherwise by reading the whole manifest.
+    """
+
+    def __init__(self, app, datasets, swap):
+        """Constructor. `swap(new)` installs a new manifest."""
+        self.app = app
+        self.datasets = datasets
+        self.swap = swap
+        self.interval = app.config['MANIFEST_CHECK_INTERVAL']
+        self._last_check = time.monotonic()
+        self._lock = Lock()
+
+    def _path(self, key):
+        return self.app.config['PORTAL_ROOT'] + self.app.config[key]
+
+    def check(self):
+        """Reload the manifest if a new build is out. Cheap if called often."""
+        now = time.monotonic()
+        if not self.interval or now - self._last_check < self.interval:
+            return
+        if not self._lock.acquire(blocking=False):
+            return  # another thread is checking
+        try:
+            self._last_check = now
+            self.reload()
+        except (OSError, ValueError, KeyError):
+            # half-published build? try again next time
+            self.app.logger.exception('Failed to reload the manifest')
+        finally:
+            self._lock.release()
+
+    def reload(self):
+        """Load the published manifest, if its version differs from ours."""
+        try:
+            with open(self._path('DATASETS_VERSION')) as f:
+                version = f.read().strip()
+        except FileNotFoundError:
+            return
+
+        current = self.datasets.get('version')
+        if version == current:
+            return
+
+        new = None
+        try:
+            with open(self._path('DATASETS_DELTA')) as f:
+                delta = json.load(f)
+            if current and delta['from'] == current and delta['to'] == version:
+                new = apply_delta(self.datasets, delta)
+        except FileNotFoundError:
+            pass
+
+        if new is None:
+            with open(self._path('DATASETS')) as f:
+                new = json.load(f)
+            if new.get('version') != version:
+                return  # caught a build mid-write
+
+        self.swap(new)
+        self.app.logger.info('Loaded manifest version %s (was %s)',
+                             version, current)
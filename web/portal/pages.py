@@ -0,0 +1,101 @@
+"""Pre-rendered pages that only depend on the config and the manifest."""
+
+import hashlib
+import re
+from threading import Lock
+
+from flask import make_response, render_template, request, session
+
+# Max number of cached navbar variants (one per logged-in username)
+MAX_NAVUSER = 4096
+
+# Per-request fragments, rendered as these markers when pre-rendering
+FRAGMENTS = {'<!--portal:navuser-->': 'navuser.jinja2',
+             '<!--portal:messages-->': 'messages.jinja2',
+             }
+MARKER_RE = re.compile('(' + '|'.join(map(re.escape, FRAGMENTS)) + ')')
+
+
+class PageCache:
+    """
+    Cache of rendered pages as bytes, with ETags.
+
+    Pages are rendered once with `prerender=True`, which makes the templates
+    emit markers in place of the per-request parts (the navbar user links
+    and flashed messages). At request time, only those small fragments are
+    rendered and spliced in. Call `render_all()` when the manifest changes.
+    """
+
+    def __init__(self, app):
+        """Constructor."""
+        self.app = app
+        self._renderers = {}
+        self._pages = {}
+        self._navuser = {}
+        self._lock = Lock()
+
+    def register(self, name, template, context=dict):
+        """Register a page; `context()` returns its template variables."""
+        self._renderers[name] = (template, context)
+
+    def render_all(self):
+        """(Re-)render all registered pages."""
+        pages = {name: self._render(name) for name in self._renderers}
+        with self._lock:
+            self._pages = pages
+            self._navuser = {}
+
+    def _render(self, name):
+        template, context = self._renderers[name]
+        with self.app.test_request_context():
+            html = render_template(template, prerender=True, **context())
+
+        # alternating static bytes and fragment template names
+        parts = MARKER_RE.split(html)
+        parts = [FRAGMENTS[p] if i % 2 else p.encode()
+                 for i, p in enumerate(parts)]
+
+        etag = hashlib.sha1(html.encode()).hexdigest()
+        return parts, etag
+
+    def response(self, name):
+        """Return the response for a page, rendering it if not cached."""
+        if not self.app.config['PRERENDER_PAGES']:
+            template, context = self._renderers[name]
+            return render_template(template, **context())
+
+        with self._lock:
+            if name not in self._pages:
+                self._pages[name] = self._render(name)
+            parts, etag = self._pages[name]
+
+        body = []
+        dynamic = hashlib.sha1()
+        for part in parts:
+            if isinstance(part, str):
+                part = self._fragment(part)
+                dynamic.update(part)
+            body += [part]
+
+        response = make_response(b''.join(body))
+        response.set_etag(f'{etag[:16]}-{dynamic.hexdigest()[:16]}')
+        response.headers['Cache-Control'] = 'no-cache'
+
+        return response.make_conditional(request)
+
+    def _fragment(self, template):
+        """Render a per-request fragment, skipping work where possible."""
+        if template == 'messages.jinja2':
+            if '_flashes' not in session:
+                return b''
+        elif template == 'navuser.jinja2':
+            # only depends on the login state and username
+            key = (bool(session.get('is_authenticated')),
+                   session.get('primary_username'))
+            if key not in self._navuser:
+                if len(self._navuser) >= MAX_NAVUSER:
+                    self._navuser = {}
+                self._navuser[key] = render_template(template).encode()
+            return self._navuser[key]
+
+        return render_template(template).encode()
@@ -0,0 +1,106 @@
+"""LRU cache of compiled transfer plans."""
+
+import hashlib
+import json
+from collections import OrderedDict, namedtuple
+from threading import Lock
+
+# `items` are the dataset-relative paths of the selected directories, each
+# used as both the source (under the dataset root) and the destination
+# (under the user's folder); `nfile` and `size` are the totals.
+TransferPlan = namedtuple('TransferPlan', 'items nfile size')
+
+
+def canonical_selection(sims, redshifts, products):
+    """
+    Normalize a parsed selection, so that equivalent selections compare
+    equal: sims deduplicated and in ID order, redshifts formatted as in the
+    manifest keys and sorted, and (category, ftype) products deduplicated
+    and sorted.
+    """
+    sims = sorted({sim['id']: sim for sim in sims}.values(),
+                  key=lambda sim: sim['id'])
+    redshifts = sorted({str(float(z)) for z in redshifts}, key=float)
+    products = sorted({tuple(p) for p in products})
+    return sims, redshifts, products
+
+
+class PlanCache:
+    """
+    Cache of transfer plans, keyed by a hash of the canonical selection
+    and the manifest version, with least-recently-used eviction. Call
+    `clear()` when the manifest changes.
+
+    Bounded both by the number of plans and by their total number of items
+    (paths), since one full-archive plan holds ~100k paths. A plan bigger
+    than the whole item budget is returned but not cached.
+    """
+
+    def __init__(self, maxsize=256, max_items=500000):
+        """Constructor. Keeps up to `maxsize` plans and `max_items` paths."""
+        self.maxsize = maxsize
+        self.max_items = max_items
+        self._plans = OrderedDict()
+        self._nitem = 0
+        self._lock = Lock()
+
+        # metrics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(version, sims, redshifts, products):
+        """Hash a canonical selection."""
+        selection = [version, [sim['id'] for sim in sims], redshifts, products]
+        return hashlib.sha1(json.dumps(selection).encode()).hexdigest()
+
+    def get(self, version, sims, redshifts, products, compile):
+        """
+        Return the plan for a selection of the manifest with the given
+        version, calling `compile(sims, redshifts, products)` with the
+        canonical selection on a miss.
+        """
+        sims, redshifts, products = canonical_selection(sims, redshifts, products)
+        key = self.key(version, sims, redshifts, products)
+
+        with self._lock:
+            plan = self._plans.get(key)
+            if plan is not None:
+                self._plans.move_to_end(key)
+                self.hits += 1
+                return plan
+            self.misses += 1
+
+        # compile outside the lock; a concurrent miss just compiles twice
+        plan = compile(sims, redshifts, products)
+
+        if len(plan.items) > self.max_items:
+            return plan
+
+        with self._lock:
+            if key not in self._plans:
+                self._plans[key] = plan
+                self._nitem += len(plan.items)
+            self._plans.move_to_end(key)
+            while (len(self._plans) > self.maxsize
+                   or self._nitem > self.max_items):
+                _, old = self._plans.popitem(last=False)
+                self._nitem -= len(old.items)
+                self.evictions += 1
+
+        return plan
+
+    def clear(self):
+        """Drop all plans, e.g. for a new manifest."""
+        with self._lock:
+            self._plans.clear()
+            self._nitem = 0
+
+    def stats(self):
+        """Return a snapshot of the cache metrics."""
+        with self._lock:
+            nget = self.hits + self.misses
+            return dict(size=len(self._plans), nitem=self._nitem, hits=self.hits,
+                        misses=self.misses, evictions=self.evictions,
+                        hit_rate=self.hits/nget if nget else None)
@@ -0,0 +1,119 @@
+"""Background polling of Globus for the status of submitted transfers."""
+
+import os
+import socket
+import time
+import uuid
+from threading import Event, Lock, Thread
+
+from portal.lazy import globus_sdk
+
+# Max number of task IDs per endpoint manager request
+BATCH_SIZE = 50
+
+
+class TransferPoller:
+    """
+    Periodically fetch the status of all pending transfers from Globus, in
+    batches, and cache it in the database, so that page views never need to
+    make live API calls.
+
+    Uses the portal's own client identity with the endpoint manager API, so
+    the portal app must have the activity monitor role on the dataset
+    endpoint. On errors, the polling interval backs off exponentially.
+    Tasks still pending after `TRANSFER_POLL_MAX_AGE_DAYS` are marked
+    EXPIRED and no longer polled.
+
+    Every portal process (server workers, the debug reloader) gets a
+    poller, but only the one holding the lease in the database polls; the
+    others take over if it stops renewing the lease.
+    """
+
+    def __init__(self, app, database, limiter):
+        """Constructor."""
+        self.app = app
+        self.database = database
+        self.limiter = limiter
+        self.interval = app.config['TRANSFER_POLL_INTERVAL']
+        self.max_interval = app.config['TRANSFER_POLL_MAX_INTERVAL']
+        self.max_age_days = app.config['TRANSFER_POLL_MAX_AGE_DAYS']
+        self.owner = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self._transfer = None
+        self._stop = Event()
+        self._started = False
+        self._lock = Lock()
+        self._thread = Thread(target=self.run, name='transfer-poller',
+                              daemon=True)
+
+    def start(self):
+        """Start polling in a background thread."""
+        self._thread.start()
+
+    def ensure_started(self):
+        """Start polling, if not already started. Cheap if called often."""
+        if self._started:
+            return
+        with self._lock:
+            if not self._started:
+                self._started = True
+                self.start()
+
+    def stop(self):
+        """Ask the polling thread to exit."""
+        self._stop.set()
+
+    def run(self):
+        """
+        Renew the lease on a fixed cadence, and poll while holding it,
+        backing off on errors.
+        """
+        delay = self.interval
+        next_poll = time.monotonic() + delay
+        while not self._stop.wait(self.interval):
+            try:
+                with self.app.app_context():
+                    # outlive a missed renewal or two
+                    if not self.database.acquire_poller_lease(self.owner, 3 * self.interval):
+                        continue
+                if time.monotonic() < next_poll:
+                    continue
+                self.poll()
+            except Exception:
+                delay = min(2 * delay, self.max_interval)
+                self.app.logger.exception(
+                    'Transfer status poll failed; retrying in %d s', delay)
+            else:
+                delay = self.interval
+            next_poll = time.monotonic() + delay
+
+    def poll(self):
+        """Fetch and store the status of all pending tasks."""
+        with self.app.app_context():
+            self.database.expire_transfers(self.max_age_days)
+            task_ids = self.database.load_pending_task_ids(self.max_age_days)
+            if not task_ids:
+                return
+
+            if self._transfer is None:
+                # fetching the client credentials token is itself an API call
+                self._transfer = self.limiter.call(self.load_transfer_client)
+
+            transfer = self._transfer
+            for i in range(0, len(task_ids), BATCH_SIZE):
+                batch = task_ids[i:i + BATCH_SIZE]
+                tasks = self.limiter.call(
+                    lambda: list(transfer.endpoint_manager_task_list(
+                        num_results=None,
+                        filter_endpoint=self.app.config['DATASET_ENDPOINT_ID'],
+                        filter_task_id=','.join(batch))))
+                self.database.update_transfer_status(tasks)
+
+    def load_transfer_client(self):
+        """Create a TransferClient authorized as the portal itself."""
+        client = globus_sdk.ConfidentialAppAuthClient(
+            self.app.config['PORTAL_CLIENT_ID'],
+            self.app.config['PORTAL_CLIENT_SECRET'])
+        authorizer = globus_sdk.ClientCredentialsAuthorizer(
+            client, 'urn:globus:auth:scope:transfer.api.globus.org:all')
+
+        return globus_sdk.TransferClient(authorizer=authorizer)
@@ -0,0 +1,110 @@
+"""Admission control for outbound Globus API calls."""
+
+import random
+import time
+from contextlib import contextmanager
+from threading import BoundedSemaphore, Lock
+
+from portal.lazy import globus_sdk
+
+
+class GlobusLimiter:
+    """
+    Shared token-bucket rate limiter with a concurrency cap for Globus SDK
+    calls. Callers over the limit wait in line instead of failing, and
+    throttled (429) or server-error (5xx) responses are retried with
+    jittered exponential backoff.
+
+    Usage: `globus_limiter.call(transfer.submit_transfer, transfer_data)`.
+    Lazily paginated results must be consumed inside the call.
+    """
+
+    def __init__(self, rate=10., burst=20, max_concurrent=8, max_retries=4,
+                 backoff_base=0.5, backoff_max=30.):
+        """Constructor. `rate` is in calls per second."""
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self._slots = BoundedSemaphore(max_concurrent)
+        self._lock = Lock()
+        self._tokens = burst
+        self._last = time.monotonic()
+
+        # metrics
+        self.waiting = 0
+        self.max_waiting = 0
+        self.ncall = 0
+        self.nretry = 0
+
+    @classmethod
+    def from_config(cls, config):
+        """Build a limiter from the GLOBUS_* app config settings."""
+        return cls(rate=config['GLOBUS_RATE_LIMIT'],
+                   burst=config['GLOBUS_RATE_BURST'],
+                   max_concurrent=config['GLOBUS_MAX_CONCURRENT'],
+                   max_retries=config['GLOBUS_MAX_RETRIES'],
+                   )
+
+    def stats(self):
+        """Return a snapshot of the limiter metrics."""
+        with self._lock:
+            return dict(waiting=self.waiting, max_waiting=self.max_waiting,
+                        ncall=self.ncall, nretry=self.nretry)
+
+    def call(self, fn, *args, **kwargs):
+        """Call `fn(*args, **kwargs)` under the rate and concurrency limits."""
+        attempt = 0
+        while True:
+            with self._admitted():
+                try:
+                    return fn(*args, **kwargs)
+                except globus_sdk.GlobusAPIError as err:
+                    if (not self._retryable(err)
+                            or attempt >= self.max_retries):
+                        raise
+
+            # back off outside of the concurrency slot
+            delay = min(self.backoff_max, self.backoff_base * 2**attempt)
+            time.sleep(random.uniform(0, delay))
+            attempt += 1
+            with self._lock:
+                self.nretry += 1
+
+    @staticmethod
+    def _retryable(err):
+        return err.http_status == 429 or err.http_status >= 500
+
+    @contextmanager
+    def _admitted(self):
+        """Wait for a token and a concurrency slot; release the slot after."""
+        with self._lock:
+            self.waiting += 1
+            self.max_waiting = max(self.max_waiting, self.waiting)
+        try:
+            self._take_token()
+            self._slots.acquire()
+        finally:
+            with self._lock:
+                self.waiting -= 1
+                self.ncall += 1
+
+        try:
+            yield
+        finally:
+            self._slots.release()
+
+    def _take_token(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst,
+                                   self._tokens + (now - self._last)*self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens)/self.rate
+            time.sleep(wait)
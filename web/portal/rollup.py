@@ -0,0 +1,84 @@
+"""Archive-wide file counts and sizes, from the rollup cube."""
+
+import json
+from collections import defaultdict
+
+# Must match ROLLUP_AXES in build_manifest.py
+AXES = ('family', 'cosmology', 'product', 'ftype', 'redshift')
+
+
+class Rollup:
+    """
+    The sparse cube of [nfile, size] over AXES written by build_manifest.py,
+    queryable by slice and group. The grand total is precomputed; any other
+    query is one pass over the non-empty cells.
+    """
+
+    def __init__(self, fn):
+        """Constructor. Loads the cube from `fn`, if it exists."""
+        self.fn = fn
+        self.load()
+
+    def load(self):
+        """(Re-)load the cube, e.g. for a new manifest."""
+        try:
+            with open(self.fn) as f:
+                cube = json.load(f)
+        except FileNotFoundError:
+            cube = dict(version=None, axes={axis: [] for axis in AXES},
+                        index=[[] for axis in AXES], nfile=[], du=[])
+
+        lookup = {axis: {v: i for i, v in enumerate(cube['axes'][axis])}
+                  for axis in AXES}
+        cells = list(zip(zip(*cube['index']), cube['nfile'], cube['du']))
+        total = (sum(cube['nfile']), sum(cube['du']))
+
+        # swap in one assignment, for concurrent readers
+        self._cube = (cube['version'], cube['axes'], lookup, cells, total)
+
+    @property
+    def version(self):
+        return self._cube[0]
+
+    @property
+    def axes(self):
+        """The labels along each axis."""
+        return self._cube[1]
+
+    @property
+    def total(self):
+        """The (nfile, size) of the whole archive."""
+        return self._cube[4]
+
+    def query(self, filters=None, groupby=()):
+        """
+        Sum over the cells whose labels are in `filters` ({axis: values}),
+        grouped by the `groupby` axes. Returns a list of dicts with the
+        group's labels, `nfile`, and `size`, in axis label order. Without
+        `groupby`, that's always one dict, zero if nothing matched.
+        """
+        version, axes, lookup, cells, total = self._cube
+        filters = filters or {}
+
+        if not filters and not groupby:
+            return [dict(nfile=total[0], size=total[1])]
+
+        allowed = [{lookup[axis][v] for v in filters[axis] if v in lookup[axis]}
+                   if axis in filters else None
+                   for axis in AXES]
+        allowed = [(i, a) for i, a in enumerate(allowed) if a is not None]
+        group = [AXES.index(axis) for axis in groupby]
+
+        sums = defaultdict(lambda: [0, 0])
+        for key, nfile, size in cells:
+            if all(key[i] in a for i, a in allowed):
+                s = sums[tuple(key[i] for i in group)]
+                s[0] += nfile
+                s[1] += size
+
+        if not groupby and not sums:
+            return [dict(nfile=0, size=0)]
+
+        return [dict({axis: axes[axis][i] for axis, i in zip(groupby, gkey)},
+                     nfile=s[0], size=s[1])
+                for gkey, s in sorted(sums.items())]
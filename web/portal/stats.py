@@ -0,0 +1,42 @@
+"""Operational metrics of the portal components, for logs and /health."""
+
+import json
+import time
+from threading import Lock
+
+
+class StatsReporter:
+    """
+    Collects the `stats()` of registered components (e.g. the Globus
+    limiter's queue depth), served by the /health endpoint and logged every
+    `STATS_LOG_INTERVAL` seconds.
+    """
+
+    def __init__(self, app):
+        """Constructor."""
+        self.app = app
+        self.interval = app.config['STATS_LOG_INTERVAL']
+        self._sources = {}
+        self._last_log = time.monotonic()
+        self._lock = Lock()
+
+    def register(self, name, stats):
+        """Report `stats()` under `name`."""
+        self._sources[name] = stats
+
+    def snapshot(self):
+        """Return the current stats of every registered component."""
+        return {name: stats() for name, stats in self._sources.items()}
+
+    def check(self):
+        """Log the stats if they're due. Cheap if called often."""
+        now = time.monotonic()
+        if not self.interval or now - self._last_log < self.interval:
+            return
+        if not self._lock.acquire(blocking=False):
+            return  # another thread is logging
+        try:
+            self._last_log = now
+            self.app.logger.info('Portal stats: %s', json.dumps(self.snapshot()))
+        finally:
+            self._lock.release()
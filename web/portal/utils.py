@@ -1,14 +1,13 @@
-from flask import request
+from flask import request, session
 from threading import Lock
 
-import globus_sdk
-
 try:
     from urllib.parse import urlparse, urljoin
 except ImportError:
     from urlparse import urlparse, urljoin
 
-from portal import app
+from portal import app, globus_limiter
+from portal.lazy import globus_sdk
 
 
 def load_portal_client():
@@ -17,6 +16,19 @@ def load_portal_client():
         app.config['PORTAL_CLIENT_ID'], app.config['PORTAL_CLIENT_SECRET'])
 
 
+def load_transfer_client():
+    """Create a TransferClient with the logged-in user's tokens"""
+    transfer_tokens = session['tokens']['transfer.api.globus.org']
+
+    authorizer = globus_sdk.RefreshTokenAuthorizer(
+        transfer_tokens['refresh_token'],
+        load_portal_client(),
+        access_token=transfer_tokens['access_token'],
+        expires_at=transfer_tokens['expires_at_seconds'])
+
+    return globus_sdk.TransferClient(authorizer=authorizer)
+
+
 def is_safe_redirect_url(target):
     """https://security.openstack.org/guidelines/dg_avoid-unvalidated-redirects.html"""  # noqa
     host_url = urlparse(request.host_url)
@@ -52,7 +64,8 @@ def get_portal_tokens(
         scope_string = ' '.join(scopes)
 
         client = load_portal_client()
-        tokens = client.oauth2_client_credentials_tokens(
+        tokens = globus_limiter.call(
+            client.oauth2_client_credentials_tokens,
             requested_scopes=scope_string)
 
         # walk all resource servers in the token response (includes the
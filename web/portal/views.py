@@ -1,24 +1,38 @@
-from flask import (abort, flash, redirect, render_template, request, session,
-                   url_for)
-from globus_sdk import (RefreshTokenAuthorizer, TransferAPIError,
-                        TransferClient, TransferData)
+from flask import (Response, abort, flash, jsonify, redirect, render_template,
+                   request, session, url_for)
 
-from portal import app, database, datasets, dataset_desc
+from portal import (app, database, datasets, dataset_desc, file_index,
+                    globus_limiter, pages, rollup, stats_reporter,
+                    transfer_plans)
 from portal.decorators import authenticated
-from portal.utils import get_safe_redirect, load_portal_client
+from portal.idranges import decode_id_ranges
+from portal.lazy import globus_sdk
+from portal.plans import TransferPlan
+from portal.rollup import AXES as ROLLUP_AXES
+from portal.utils import (get_safe_redirect, load_portal_client,
+                          load_transfer_client)
 
 try:
-    from urllib.parse import urlencode
+    from urllib.parse import quote, urlencode
 except ImportError:
-    from urllib import urlencode
+    from urllib import quote, urlencode
     
+import json
 from pathlib import PurePosixPath as GlobusPath
 
+SELECTION_KEYS = 'redshifts[]', 'products[]', 'simids[]'
+
+# File list export format -> (download filename, MIME type)
+EXPORT_FORMATS = {'wget': ('abacussummit-urls.txt', 'text/plain'),
+                  'txt': ('abacussummit-files.tsv', 'text/tab-separated-values'),
+                  'jsonl': ('abacussummit-files.jsonl', 'application/jsonl'),
+                  }
+
 
 @app.route('/', methods=['GET'])
 def home():
     """Home page - play with it if you must!"""
-    return render_template('home.jinja2')
+    return pages.response('home')
 
 
 @app.route('/signup', methods=['GET'])
@@ -36,7 +50,7 @@ def login():
 @app.route('/about', methods=['GET'])
 def about():
     """About page - for information about this portal!"""
-    return render_template('about.jinja2')
+    return pages.response('about')
 
 
 @app.route('/logout', methods=['GET'])
@@ -58,7 +72,8 @@ def logout():
             for ty in ('access_token', 'refresh_token')
             # only where the relevant token is actually present
             if token_info[ty] is not None):
-        client.oauth2_revoke_token(
+        globus_limiter.call(
+            client.oauth2_revoke_token,
             token, additional_params={'token_type_hint': token_type})
 
     # Destroy the session state
@@ -157,9 +172,10 @@ def authcallback():
         # If we do have a "code" param, we're coming back from Globus Auth
         # and can start the process of exchanging an auth code for a token.
         code = request.args.get('code')
-        tokens = client.oauth2_exchange_code_for_tokens(code)
+        tokens = globus_limiter.call(
+            client.oauth2_exchange_code_for_tokens, code)
 
-        id_token = tokens.decode_id_token(client)
+        id_token = globus_limiter.call(tokens.decode_id_token, client)
         session.update(
             tokens=tokens.by_resource_server,
             is_authenticated=True,
@@ -224,26 +240,19 @@ def browse(dataset_id=None, endpoint_id=None, endpoint_path=None):
     else:
         endpoint_path = '/' + endpoint_path
 
-    transfer_tokens = session['tokens']['transfer.api.globus.org']
-
-    authorizer = RefreshTokenAuthorizer(
-        transfer_tokens['refresh_token'],
-        load_portal_client(),
-        access_token=transfer_tokens['access_token'],
-        expires_at=transfer_tokens['expires_at_seconds'])
-
-    transfer = TransferClient(authorizer=authorizer)
+    transfer = load_transfer_client()
 
     try:
-        transfer.endpoint_autoactivate(endpoint_id)
-        listing = transfer.operation_ls(endpoint_id, path=endpoint_path)
-    except TransferAPIError as err:
+        globus_limiter.call(transfer.endpoint_autoactivate, endpoint_id)
+        listing = globus_limiter.call(transfer.operation_ls, endpoint_id,
+                                      path=endpoint_path)
+    except globus_sdk.TransferAPIError as err:
         flash('Error [{}]: {}'.format(err.code, err.message))
         return redirect(url_for('transfer'))
 
     file_list = [e for e in listing if e['type'] == 'file']
 
-    ep = transfer.get_endpoint(endpoint_id)
+    ep = globus_limiter.call(transfer.get_endpoint, endpoint_id)
 
     https_server = ep['https_server']
     endpoint_uri = https_server + endpoint_path if https_server else None
@@ -266,24 +275,11 @@ def transfer():
       Browse Endpoint helper page.
     """
     if request.method == 'GET':
-        endpoint_id = app.config['DATASET_ENDPOINT_ID']
-        endpoint_path = app.config['DATASET_ENDPOINT_BASE']
-        browse_endpoint = f'https://app.globus.org/file-manager?{urlencode(dict(origin_id=endpoint_id,origin_path=endpoint_path))}'
-        
-        return render_template('transfer.jinja2',
-                               dataset_uri=app.config['DATASETS_TABLE'],
-                               browse_endpoint=browse_endpoint,
-                               redshifts=datasets['redshifts'],
-                               products=dataset_desc['products'],
-                              )
+        return pages.response('transfer')
 
     if request.method == 'POST':
-        keys = 'redshifts[]', 'products[]', 'simids[]'
-        for k in keys:
-            if not request.form.getlist(k):
-                # Not supposed to happen
-                flash('Please select redshifts, products, and simulations.')
-                return redirect(url_for('transfer'))
+        if not validate_selection(request.form):
+            return redirect(url_for('transfer'))
 
         params = {
             'method': 'POST',
@@ -297,42 +293,254 @@ def transfer():
         browse_endpoint = 'https://app.globus.org/file-manager?{}' \
             .format(urlencode(params))
         
-        session['form'] = {k:request.form.getlist(k) for k in keys}
+        session['form'] = {k:request.form.getlist(k) for k in SELECTION_KEYS}
 
         return redirect(browse_endpoint)
 
 
-def transfer_datasets(params):
+def transfer_page_context():
+    """Template variables for the transfer page, which depend only on the
+    config and manifest."""
+    endpoint_id = app.config['DATASET_ENDPOINT_ID']
+    endpoint_path = app.config['DATASET_ENDPOINT_BASE']
+    browse_endpoint = f'https://app.globus.org/file-manager?{urlencode(dict(origin_id=endpoint_id,origin_path=endpoint_path))}'
+
+    return dict(dataset_uri=app.config['DATASETS_TABLE'],
+                dataset_delta_uri=app.config['DATASETS_TABLE_DELTA'],
+                manifest_version=datasets.get('version', ''),
+                browse_endpoint=browse_endpoint,
+                redshifts=datasets['redshifts'],
+                products=dataset_desc['products'],
+                archive_nfile=rollup.total[0],
+                archive_size=rollup.total[1],
+               )
+
+
+pages.register('home', 'home.jinja2')
+pages.register('about', 'about.jinja2')
+pages.register('transfer', 'transfer.jinja2', transfer_page_context)
+
+
+def validate_selection(form):
+    """Check a submitted selection form, flashing a message if invalid."""
+    # products are "category.ftype", e.g. "halos.halo_info"
+    products = [p.split('.') for p in ','.join(form.getlist('products[]')).split(',') if p]
+    for p in products:
+        if (len(p) != 2 or p[0] not in datasets['products']
+                or p[1] not in datasets['products'][p[0]]['ftypes']):
+            flash('Invalid product selection.')
+            return False
+
+    try:
+        for z in form.getlist('redshifts[]'):
+            float(z)
+    except ValueError:
+        flash('Invalid redshift selection.')
+        return False
+
+    # redshifts are optional if only light cones are selected
+    categories = {p[0] for p in products}
+    required = SELECTION_KEYS if any(map(has_redshifts, categories)) else SELECTION_KEYS[1:]
+    for k in required:
+        if not form.getlist(k):
+            # Not supposed to happen
+            flash('Please select redshifts, products, and simulations.')
+            return False
+
+    try:
+        # simids is a compact range string like "0-99,105"
+        decode_id_ranges(form['simids[]'],
+                         limit=max(sim['id'] for sim in datasets['data']) + 1)
+    except ValueError:
+        flash('Invalid simulation selection.')
+        return False
+
+    return True
+
+
+def parse_selection(form):
     """
-    - Take the data returned by the Browse Endpoint helper page
-      and make a Globus transfer request.
-    - Send the user to the transfer status page with the task id
-      from the transfer.
+    Turn the saved selection form into (sims, redshifts, products), where
+    products is a list of (category, ftype) pairs.
     """
-
-    redshifts = session['form']['redshifts[]']
-    products  = session['form']['products[]']
-    simids    = session['form']['simids[]']
+    redshifts = form['redshifts[]']
+    products  = form['products[]']
+    simids    = form['simids[]']
     
-    # simids is actually a singlet string, just to try to keep the POST small
-    simids = list(map(int, simids[0].split(',')))
-    simids = list(dict.fromkeys(simids))  # dedupe
+    # simids is a singlet range string like "0-99,105", to keep the POST small
+    simids = decode_id_ranges(simids[0])
     sims = [sim for sim in datasets['data'] if sim['id'] in simids]
     
     # flatten products
     products = sum((p.strip(',').split(',') for p in products), [])
     products = list(dict.fromkeys(products))  # dedupe
     products = [ p.split('.') for p in products ]  # [ ('halos','halo_info'), ('power','AB'), ('power','pack9')]
-    
-    transfer_tokens = session['tokens']['transfer.api.globus.org']
 
-    authorizer = RefreshTokenAuthorizer(
-        transfer_tokens['refresh_token'],
-        load_portal_client(),
-        access_token=transfer_tokens['access_token'],
-        expires_at=transfer_tokens['expires_at_seconds'])
+    return sims, redshifts, products
+
+
+def has_redshifts(category):
+    """Whether a product category is split into redshift directories (the
+    light cones aren't)."""
+    return datasets['products'].get(category, {}).get('redshifts', True)
+
+
+def iter_selection_du(sims, redshifts, products):
+    """
+    Generate the path of each sim/z/ftype directory in the selection that
+    exists in the manifest, relative to the dataset root, with its
+    [nfile, size].  Products without redshifts contribute their sim/ftype
+    directories, regardless of the redshift selection.
+    """
+    for sim in sims:
+        for z in redshifts:
+            zstr = f'z{float(z):.3f}'
+            for category,ftype in products:
+                if not has_redshifts(category):
+                    continue
+                if category not in sim or z not in sim[category] or ftype not in sim[category][z]:
+                    continue
+                
+                pathfmt = datasets['products'][category]['path']  # cleaning/{}
+                yield (GlobusPath(pathfmt.format(sim['root'])) / zstr / ftype,
+                       sim[category][z][ftype])
+
+        for category,ftype in products:
+            if has_redshifts(category) or ftype not in sim.get(category, {}):
+                continue
+            pathfmt = datasets['products'][category]['path']  # {}/lightcones
+            yield (GlobusPath(pathfmt.format(sim['root'])) / ftype,
+                   sim[category][ftype])
+
+
+def compile_plan(sims, redshifts, products):
+    """Build the TransferPlan for a selection."""
+    items = []
+    nfile = size = 0
+    for path, du in iter_selection_du(sims, redshifts, products):
+        items += [str(path)]
+        nfile += du[0]
+        size += du[1]
+    return TransferPlan(tuple(items), nfile, size)
+
+
+def transfer_plan(form):
+    """Return the (cached) TransferPlan for a saved selection form."""
+    return transfer_plans.get(datasets.get('version'), *parse_selection(form),
+                              compile=compile_plan)
+
+
+@app.route('/health', methods=['GET'])
+def health():
+    """Operational metrics, e.g. how many Globus calls are queued."""
+    return jsonify(stats_reporter.snapshot())
+
 
-    transfer = TransferClient(authorizer=authorizer)
+@app.route('/api/rollup', methods=['GET'])
+def rollup_api():
+    """
+    Archive-wide file counts and sizes, summed over a slice of the rollup
+    cube. Each axis (family, cosmology, product, ftype, redshift) is an
+    optional comma-separated filter, and `groupby` lists the axes to group
+    by; light cones have the redshift "none". For example,
+    `/api/rollup?ftype=halo_info&redshift=0.5&cosmology=c000`, or
+    `/api/rollup?groupby=product,cosmology`.
+    """
+    filters = {}
+    for axis in ROLLUP_AXES:
+        values = request.args.get(axis)
+        if values is None:
+            continue
+        values = values.split(',')
+        if axis == 'redshift':
+            try:
+                values = [None if z.lower() in ('none', 'null') else float(z)
+                          for z in values]
+            except ValueError:
+                abort(400)
+        filters[axis] = values
+
+    groupby = [axis for axis in request.args.get('groupby', '').split(',') if axis]
+    if any(axis not in ROLLUP_AXES for axis in groupby):
+        abort(400)
+
+    return jsonify(version=rollup.version, groupby=groupby,
+                   rows=rollup.query(filters, groupby))
+
+
+@app.route('/export', methods=['POST'])
+@authenticated
+def export_file_list():
+    """
+    Stream a list of the files in the submitted selection, for download
+    over HTTPS with wget, curl, etc. The `format` form field is one of:
+
+    - `wget` (default): one URL per line, for `wget -x -nH -i`
+    - `txt`: tab-separated URL, relative path, and size in bytes
+    - `jsonl`: JSON lines with `url`, `path`, and `size` keys
+    """
+    if not validate_selection(request.form):
+        return redirect(url_for('transfer'))
+
+    fmt = request.form.get('format', 'wget')
+    if fmt not in EXPORT_FORMATS:
+        abort(400)
+
+    base_url = dataset_https_server()
+    if not base_url:
+        flash('HTTPS downloads are not available for this dataset.')
+        return redirect(url_for('transfer'))
+    base_url += quote(app.config['DATASET_ENDPOINT_BASE'].rstrip('/') + '/')
+
+    form = {k:request.form.getlist(k) for k in SELECTION_KEYS}
+    dirs = transfer_plan(form).items
+
+    def generate():
+        for path, size in file_index.iter_files(dirs):
+            url = base_url + quote(path)
+            if fmt == 'wget':
+                yield url + '\n'
+            elif fmt == 'jsonl':
+                yield json.dumps(dict(url=url, path=path, size=size)) + '\n'
+            else:
+                yield f'{url}\t{path}\t{size}\n'
+
+    filename, mimetype = EXPORT_FORMATS[fmt]
+    return Response(generate(), mimetype=mimetype,
+                    headers={'Content-Disposition':
+                             f'attachment; filename={filename}'})
+
+
+def dataset_https_server():
+    """
+    Return the HTTPS server URL of the dataset endpoint, or None if it has
+    none. Looked up from Globus once, unless set in the config.
+    """
+    if app.config['DATASET_HTTPS_SERVER'] is None:
+        transfer = load_transfer_client()
+
+        try:
+            ep = globus_limiter.call(transfer.get_endpoint,
+                                     app.config['DATASET_ENDPOINT_ID'])
+        except globus_sdk.TransferAPIError:
+            return None
+        # an empty string records "no HTTPS server" so we don't ask again
+        app.config['DATASET_HTTPS_SERVER'] = ep['https_server'] or ''
+
+    return app.config['DATASET_HTTPS_SERVER']
+
+
+def transfer_datasets(params):
+    """
+    - Take the data returned by the Browse Endpoint helper page
+      and make a Globus transfer request.
+    - Send the user to the transfer status page with the task id
+      from the transfer.
+    """
+
+    plan = transfer_plan(session['form'])
+    
+    transfer = load_transfer_client()
 
     source_endpoint_id = app.config['DATASET_ENDPOINT_ID']
     source_endpoint_base = GlobusPath(app.config['DATASET_ENDPOINT_BASE'])
@@ -344,41 +552,55 @@ def transfer_datasets(params):
 
     label = params.get('label') or None
 
-    transfer_data = TransferData(transfer_client=transfer,
-                                 source_endpoint=source_endpoint_id,
-                                 destination_endpoint=destination_endpoint_id,
-                                 label=label,
-                                 encrypt_data=False,verify_checksum=False,
-                                 sync_level=app.config['GLOBUS_SYNC_LEVEL'],
-                                )
+    # an explicit submission ID makes retried submissions idempotent
+    submission_id = globus_limiter.call(transfer.get_submission_id)['value']
 
-    for sim in sims:
-        for z in redshifts:
-            zstr = f'z{float(z):.3f}'
-            for category,ftype in products:
-                if category not in sim or z not in sim[category] or ftype not in sim[category][z]:
-                    continue
-                
-                pathfmt = datasets['products'][category]['path']  # cleaning/{}
-                source_path = source_endpoint_base / pathfmt.format(sim['root']) / zstr / ftype
-                dest_path = dest_path_base / pathfmt.format(sim['root']) / zstr / ftype
+    transfer_data = globus_sdk.TransferData(transfer_client=transfer,
+                                            source_endpoint=source_endpoint_id,
+                                            destination_endpoint=destination_endpoint_id,
+                                            label=label,
+                                            submission_id=submission_id,
+                                            encrypt_data=False,verify_checksum=False,
+                                            sync_level=app.config['GLOBUS_SYNC_LEVEL'],
+                                           )
 
-                transfer_data.add_item(source_path=source_path,
-                                       destination_path=dest_path,
-                                       recursive=True)
+    for path in plan.items:
+        transfer_data.add_item(source_path=source_endpoint_base / path,
+                               destination_path=dest_path_base / path,
+                               recursive=True)
 
-    transfer.endpoint_autoactivate(source_endpoint_id)
-    transfer.endpoint_autoactivate(destination_endpoint_id)
-    task_id = transfer.submit_transfer(transfer_data)['task_id']
+    globus_limiter.call(transfer.endpoint_autoactivate, source_endpoint_id)
+    globus_limiter.call(transfer.endpoint_autoactivate, destination_endpoint_id)
+    task_id = globus_limiter.call(transfer.submit_transfer,
+                                  transfer_data)['task_id']
+
+    database.save_transfer(identity_id=session['primary_identity'],
+                           task_id=task_id,
+                           label=label)
 
     status_uri = f'https://app.globus.org/activity/{task_id}'
     status_uri = f'<a href="{status_uri}" target="_blank">{status_uri} <i class="fas fa-external-link-alt"></i></a>'
-    flash('Transfer request submitted successfully! View transfer status on Globus: ' + status_uri)
+    transfers_uri = f'<a href="{url_for("transfers")}">My transfers</a>'
+    flash(f'Transfer request for {plan.nfile} files ({plan.size/1e9:.1f} GB) submitted successfully! '
+          'View transfer status on Globus: ' + status_uri + ', or under ' + transfers_uri + '.')
 
     return(redirect(url_for('transfer', task_id=task_id)))
 
 
 
+@app.route('/transfers', methods=['GET'])
+@authenticated
+def transfers():
+    """
+    List the user's submitted transfers. The status shown is the cached
+    status from the background poller, not a live Globus query.
+    """
+    transfer_list = database.load_transfers(session['primary_identity'])
+
+    return render_template('transfers.jinja2', transfer_list=transfer_list,
+                           max_age_days=app.config['TRANSFER_POLL_MAX_AGE_DAYS'])
+
+
 @app.route('/submit-transfer', methods=['GET'])
 @authenticated
 def process_inflight_transfer():
@@ -397,15 +619,7 @@ def submit_transfer():
     """
     browse_endpoint_form = request.form
 
-    transfer_tokens = session['tokens']['transfer.api.globus.org']
-
-    authorizer = RefreshTokenAuthorizer(
-        transfer_tokens['refresh_token'],
-        load_portal_client(),
-        access_token=transfer_tokens['access_token'],
-        expires_at=transfer_tokens['expires_at_seconds'])
-
-    transfer = TransferClient(authorizer=authorizer)
+    transfer = load_transfer_client()
 
     transfer_params = {
         'source_endpoint_id': app.config['DATASET_ENDPOINT_ID'],
@@ -416,7 +630,8 @@ def submit_transfer():
         'label': browse_endpoint_form.get('label')
     }
 
-    destination = transfer.get_endpoint(transfer_params['destination_endpoint_id'])
+    destination = globus_limiter.call(transfer.get_endpoint,
+                                      transfer_params['destination_endpoint_id'])
 
     try:
         [major, minor, _patch] = destination['gcs_version'].split('.')
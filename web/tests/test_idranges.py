@@ -0,0 +1,83 @@
+"""Round-trip tests of decode_id_ranges() against the page's encoder."""
+
+import importlib.util
+import random
+from pathlib import Path
+
+import pytest
+
+# load the module by path: importing the portal package starts the whole app
+_spec = importlib.util.spec_from_file_location(
+    'idranges', Path(__file__).parents[1] / 'portal' / 'idranges.py')
+idranges = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(idranges)
+decode_id_ranges = idranges.decode_id_ranges
+
+
+def encode_id_ranges(ids):
+    """Reference encoder, a port of `encode_id_ranges()` in scripts.jinja2."""
+    ranges = []
+    for i in sorted(set(ids)):
+        if ranges and i == ranges[-1][1] + 1:
+            ranges[-1][1] = i
+        else:
+            ranges.append([i, i])
+    return ','.join(str(lo) if lo == hi else f'{lo}-{hi}' for lo, hi in ranges)
+
+
+@pytest.mark.parametrize('seed', range(200))
+def test_round_trip(seed):
+    rng = random.Random(seed)
+    limit = rng.randint(1, 2000)
+    # mix sparse picks with dense runs, so both singletons and ranges occur
+    ids = set(rng.sample(range(limit), rng.randint(0, min(limit, 50))))
+    for _ in range(rng.randint(0, 5)):
+        lo = rng.randrange(limit)
+        ids.update(range(lo, min(limit, lo + rng.randint(1, 100))))
+
+    s = encode_id_ranges(ids)
+    assert decode_id_ranges(s, limit=limit) == ids
+    assert decode_id_ranges(s) == ids
+
+
+@pytest.mark.parametrize('seed', range(50))
+def test_overlapping_unordered(seed):
+    rng = random.Random(seed)
+    ids = set()
+    toks = []
+    for _ in range(rng.randint(1, 10)):
+        lo = rng.randrange(100)
+        hi = lo + rng.randrange(20)
+        ids.update(range(lo, hi + 1))
+        toks.append(f' {lo}-{hi} ' if lo != hi or rng.random() < 0.5 else str(lo))
+    # overlapping, repeated, and out-of-order ranges decode to their union
+    assert decode_id_ranges(','.join(toks + toks[:2])) == ids
+
+
+@pytest.mark.parametrize('s, ids', [
+    ('', set()),
+    ('7', {7}),
+    ('0-0', {0}),
+    ('3,1,2', {1, 2, 3}),
+    ('0-3,2-5', set(range(6))),
+    ('1-4,2-3', {1, 2, 3, 4}),
+    ('5,,6,', {5, 6}),
+])
+def test_decode(s, ids):
+    assert decode_id_ranges(s) == ids
+
+
+@pytest.mark.parametrize('s', [
+    '5-', '-5', '3-1', '-', '1-2-3', '--1', 'a', '1-b', '1.5',
+    '+5', '1_0', '٣', '5 6',
+])
+def test_malformed(s):
+    with pytest.raises(ValueError):
+        decode_id_ranges(s)
+
+
+def test_limit():
+    assert decode_id_ranges('0-9', limit=10) == set(range(10))
+    for s in ('10', '9-10', '0-3,10', '5-1000'):
+        with pytest.raises(ValueError, match='out of range'):
+            decode_id_ranges(s, limit=10)